@@ -0,0 +1,283 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module evaluates pipelines of named GRL operations in one process.
+Each source is loaded once, intermediate GRLs are kept in memory and only
+the requested outputs are written.
+
+A pipeline is a dict (read from JSON or YAML) such as::
+
+    {"sources": {"A": "A.xml", "B": "B.xml"},
+     "steps": {"AB": {"op": "and", "args": ["A", "B"]},
+               "early": {"op": "clip", "args": ["AB"], "endrun": 180000}},
+     "outputs": {"AB": "AB.xml", "early": "early.yml"}}
+
+or a script with one statement per line::
+
+    A = load A.xml
+    B = load B.xml
+    AB = and A B
+    early = clip AB endrun=180000
+    write AB AB.xml
+    write early early.yml
+"""
+
+from .grl import GRL, load_many, anded, ored, xored, diffed, clipped
+
+import os
+import sys
+
+
+__all__ = [
+    'Pipeline',
+    'OPERATIONS',
+]
+
+
+OPERATIONS = {
+    'and': anded,
+    'or': ored,
+    'xor': xored,
+    'diff': diffed,
+    'clip': clipped,
+}
+
+
+def _evaluate(args):
+    """
+    Apply an operation to GRLs (also used in worker processes)
+    """
+    op, grls, kwargs = args
+    return OPERATIONS[op](*grls, **kwargs)
+
+
+def _parse_value(value):
+
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class Pipeline(object):
+    """
+    Named GRL sources, operations between them and the outputs to write
+    """
+    def __init__(self, sources=None, steps=None, outputs=None, format=None):
+        """
+        *sources*: dict
+            Mapping of names to anything accepted by GRL()
+
+        *steps*: dict
+            Mapping of names to dicts containing the "op" (one of and, or,
+            xor, diff or clip), the "args" (names of sources or other steps)
+            and any keyword arguments of the operation
+
+        *outputs*: dict
+            Mapping of names to output filenames. Use - to write XML on
+            stdout.
+
+        *format*: [ str | None ]
+            Format of the sources passed to GRL()
+        """
+        self.sources = dict(sources or {})
+        self.steps = dict(steps or {})
+        self.outputs = dict(outputs or {})
+        self.format = format
+        for name, step in self.steps.items():
+            if name in self.sources:
+                raise ValueError(
+                    "{0} is both a source and a step".format(name))
+            if step.get('op') not in OPERATIONS:
+                raise ValueError("unknown operation in step {0}: {1}".format(
+                    name, step.get('op')))
+            if not step.get('args'):
+                raise ValueError("step {0} has no arguments".format(name))
+        for name in self.outputs:
+            if name not in self.sources and name not in self.steps:
+                raise ValueError("unknown output {0}".format(name))
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Create a Pipeline from a dict with the keys sources, steps, outputs
+        and optionally format
+
+        *d*: dict
+        """
+        if not isinstance(d, dict):
+            raise ValueError("pipeline must be a mapping")
+        unknown = set(d) - set(['sources', 'steps', 'outputs', 'format'])
+        if unknown:
+            raise ValueError("unknown pipeline keys: {0}".format(
+                ', '.join(sorted(unknown))))
+        return cls(**d)
+
+    @classmethod
+    def from_script(cls, string):
+        """
+        Create a Pipeline from a script with one statement per line:
+        "NAME = load SOURCE", "NAME = OP ARG... [KEY=VALUE...]" or
+        "write NAME FILENAME". Lines starting with # are ignored.
+
+        *string*: str
+        """
+        sources = {}
+        steps = {}
+        outputs = {}
+        for number, line in enumerate(string.splitlines()):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            if words[0] == 'write' and len(words) == 3:
+                outputs[words[1]] = words[2]
+            elif len(words) >= 3 and words[1] == '=':
+                name, op, args = words[0], words[2], words[3:]
+                if name in sources or name in steps:
+                    raise ValueError("line {0:d}: {1} is already defined"
+                                     .format(number + 1, name))
+                if op == 'load':
+                    if len(args) != 1:
+                        raise ValueError("line {0:d}: load requires exactly "
+                                         "one source".format(number + 1))
+                    sources[name] = args[0]
+                    continue
+                step = {'op': op, 'args': []}
+                for arg in args:
+                    key, sep, value = arg.partition('=')
+                    if sep:
+                        step[key] = _parse_value(value)
+                    else:
+                        step['args'].append(arg)
+                steps[name] = step
+            else:
+                raise ValueError("line {0:d}: invalid statement: {1}".format(
+                    number + 1, line.strip()))
+        return cls(sources, steps, outputs)
+
+    @classmethod
+    def from_string(cls, string, format='script'):
+        """
+        Create a Pipeline from a string
+
+        *string*: str
+
+        *format*: str
+            json, yml or script
+        """
+        if format == 'json':
+            import json
+            return cls.from_dict(json.loads(string))
+        if format in ('yml', 'yaml'):
+            import yaml
+            try:
+                from yaml import CSafeLoader as Loader
+            except ImportError:
+                from yaml import SafeLoader as Loader
+            return cls.from_dict(yaml.load(string, Loader=Loader))
+        if format == 'script':
+            return cls.from_script(string)
+        raise ValueError("unknown pipeline format: {0}".format(format))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a Pipeline from a file. The format is inferred from the
+        extension: .json, .yml or .yaml, otherwise a script.
+
+        *filename*: str
+        """
+        ext = os.path.splitext(filename)[1][1:]
+        if ext not in ('json', 'yml', 'yaml'):
+            ext = 'script'
+        with open(filename) as filehandle:
+            return cls.from_string(filehandle.read(), format=ext)
+
+    def levels(self):
+        """
+        Return the list of lists of step names where the steps in each list
+        only depend on sources and steps in previous lists
+        """
+        done = set(self.sources)
+        remaining = set(self.steps)
+        levels = []
+        for name in remaining:
+            for arg in self.steps[name]['args']:
+                if arg not in self.sources and arg not in self.steps:
+                    raise ValueError("unknown argument {0} of step {1}".format(
+                        arg, name))
+        while remaining:
+            level = sorted(name for name in remaining
+                           if all(arg in done
+                                  for arg in self.steps[name]['args']))
+            if not level:
+                raise ValueError("steps depend on each other: {0}".format(
+                    ', '.join(sorted(remaining))))
+            levels.append(level)
+            done.update(level)
+            remaining.difference_update(level)
+        return levels
+
+    def needed(self):
+        """
+        Return the set of sources and steps needed by the outputs
+        """
+        needed = set()
+        names = list(self.outputs)
+        while names:
+            name = names.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            if name in self.steps:
+                names.extend(self.steps[name]['args'])
+        return needed
+
+    def run(self, jobs=1, write=True):
+        """
+        Load the sources, evaluate the steps and write the outputs.
+        Return a dict mapping the names of the sources and steps needed by
+        the outputs to their GRLs.
+
+        *jobs*: int
+            Maximum number of sources loaded at the same time and, if
+            greater than one, number of processes evaluating independent
+            steps in parallel
+
+        *write*: bool
+            If False, do not write the outputs
+        """
+        needed = self.needed()
+        names = sorted(name for name in self.sources if name in needed)
+        grls = dict(zip(names, load_many(
+            [self.sources[name] for name in names],
+            limit=jobs, format=self.format, metadata=False)))
+        pool = None
+        try:
+            for level in self.levels():
+                level = [name for name in level if name in needed]
+                tasks = []
+                for name in level:
+                    kwargs = dict(self.steps[name])
+                    op = kwargs.pop('op')
+                    args = kwargs.pop('args')
+                    tasks.append((op, [grls[arg] for arg in args], kwargs))
+                if jobs > 1 and len(tasks) > 1:
+                    if pool is None:
+                        import multiprocessing
+                        pool = multiprocessing.Pool(jobs)
+                    results = pool.map(_evaluate, tasks)
+                else:
+                    results = map(_evaluate, tasks)
+                grls.update(zip(level, results))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if write:
+            for name, output in sorted(self.outputs.items()):
+                if output == '-':
+                    grls[name].write(sys.stdout)
+                else:
+                    grls[name].save(output)
+        return grls
@@ -0,0 +1,213 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module provides a persistent SQLite catalog of the runs and lumiblocks
+contained in many GRL files
+"""
+
+from .grl import GRL
+
+import os
+import re
+import hashlib
+import sqlite3
+
+
+__all__ = [
+    'Catalog',
+    'normalize',
+]
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    source TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ranges (
+    file INTEGER NOT NULL REFERENCES files(id),
+    run INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ranges_run ON ranges (run, start, end);
+CREATE INDEX IF NOT EXISTS ranges_file ON ranges (file);
+"""
+
+
+def _filename(source):
+    """
+    Return the name of the file containing a GRL source
+    """
+    if re.search(GRL.ROOT_PATTERN, source):
+        return source.rpartition(':/')[0]
+    return source
+
+
+def normalize(source):
+    """
+    Return a source with the name of its file made absolute, so that it
+    refers to the same file from any working directory
+    """
+    if re.search(GRL.ROOT_PATTERN, source):
+        filename, _, path = source.rpartition(':/')
+        return '%s:/%s' % (os.path.abspath(filename), path)
+    return os.path.abspath(source)
+
+
+def _fingerprint(filename):
+
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as filehandle:
+        for block in iter(lambda: filehandle.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Catalog(object):
+    """
+    A SQLite catalog of the lumiblock ranges in GRL files and GRLs in
+    ROOT files. Sources are only parsed again when their modification
+    time and content change.
+    """
+    def __init__(self, filename):
+        """
+        *filename*: str
+            SQLite database file. It is created if it does not exist.
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+
+        self.connection.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+
+        self.close()
+
+    def sources(self):
+        """
+        Return the sorted list of sources in the catalog
+        """
+        return [row[0] for row in self.connection.execute(
+            'SELECT source FROM files ORDER BY source')]
+
+    def update(self, sources, format=None):
+        """
+        Add sources to the catalog or index them again if they changed
+        since they were last indexed. Return the list of sources that were
+        parsed.
+
+        *sources*: iterable
+            GRL filenames or ROOT file paths. They are stored with absolute
+            file names (see normalize()).
+
+        *format*: [ str | None ]
+            Format passed to GRL()
+
+        Each source is committed once it is indexed. ValueError naming the
+        source is raised if a source cannot be indexed.
+        """
+        parsed = []
+        for source in sources:
+            source = normalize(source)
+            # commit each source so that a bad GRL does not roll back
+            # the sources indexed before it
+            try:
+                with self.connection:
+                    if self.__index(source, format):
+                        parsed.append(source)
+            except Exception, e:
+                raise ValueError(
+                    "could not index {0}\n{1}".format(source, e))
+        return parsed
+
+    def __index(self, source, format):
+
+        filename = _filename(source)
+        mtime = os.stat(filename).st_mtime
+        row = self.connection.execute(
+            'SELECT id, mtime, fingerprint FROM files '
+            'WHERE source = ?', (source,)).fetchone()
+        if row is not None and row[1] == mtime:
+            return False
+        fingerprint = _fingerprint(filename)
+        if row is not None and row[2] == fingerprint:
+            self.connection.execute(
+                'UPDATE files SET mtime = ? WHERE id = ?',
+                (mtime, row[0]))
+            return False
+        grl = GRL(source, format=format)
+        if row is None:
+            file_id = self.connection.execute(
+                'INSERT INTO files (source, mtime, fingerprint) '
+                'VALUES (?, ?, ?)',
+                (source, mtime, fingerprint)).lastrowid
+        else:
+            file_id = row[0]
+            self.connection.execute(
+                'UPDATE files SET mtime = ?, fingerprint = ? '
+                'WHERE id = ?', (mtime, fingerprint, file_id))
+            self.connection.execute(
+                'DELETE FROM ranges WHERE file = ?', (file_id,))
+        self.connection.executemany(
+            'INSERT INTO ranges (file, run, start, end) '
+            'VALUES (?, ?, ?, ?)',
+            ((file_id, run, lbrange[0], lbrange[1])
+             for run, lbrange in grl.iterlbranges()))
+        return True
+
+    def remove(self, source):
+        """
+        Remove a source from the catalog
+
+        *source*: str
+        """
+        source = normalize(source)
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM ranges WHERE file IN '
+                '(SELECT id FROM files WHERE source = ?)', (source,))
+            self.connection.execute(
+                'DELETE FROM files WHERE source = ?', (source,))
+
+    def prune(self):
+        """
+        Remove sources whose files no longer exist from the catalog.
+        Return the list of removed sources.
+        """
+        removed = [source for source in self.sources()
+                   if not os.path.exists(_filename(source))]
+        for source in removed:
+            self.remove(source)
+        return removed
+
+    def find(self, run, lb=None):
+        """
+        Return the sorted list of sources containing a run, or a run and
+        lumiblock if lb is not None
+
+        *run*: int
+
+        *lb*: [ int | None ]
+        """
+        if lb is None:
+            rows = self.connection.execute(
+                'SELECT DISTINCT files.source FROM ranges '
+                'JOIN files ON files.id = ranges.file '
+                'WHERE ranges.run = ? ORDER BY files.source', (run,))
+        else:
+            rows = self.connection.execute(
+                'SELECT DISTINCT files.source FROM ranges '
+                'JOIN files ON files.id = ranges.file '
+                'WHERE ranges.run = ? AND ranges.start <= ? '
+                'AND ranges.end >= ? ORDER BY files.source', (run, lb, lb))
+        return [row[0] for row in rows]
@@ -0,0 +1,219 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module opens http(s) URLs over persistent connections that are reused
+for later requests to the same host. Responses are file-like objects that
+are read while the data arrives, so a GRL is parsed as it is downloaded.
+Use goodruns.load_many to download many GRLs at the same time.
+"""
+
+import threading
+import urlparse
+import httplib
+import socket
+
+
+__all__ = [
+    'ConnectionPool',
+    'urlopen',
+]
+
+
+# maximum number of idle connections kept for each host
+MAX_IDLE = 8
+MAX_REDIRECTS = 5
+
+
+class Response(object):
+    """
+    A file-like HTTP response body that returns its connection to the pool
+    once the body has been read completely
+    """
+    def __init__(self, pool, key, connection, response, url):
+
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+
+    def read(self, size=None):
+        """
+        Read up to size bytes or the whole remaining body if size is None
+        """
+        if self.response is None:
+            return ''
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        if not data or self.response.isclosed():
+            self.release()
+        return data
+
+    def release(self):
+        """
+        Return the connection to the pool if the body was read completely
+        and the server keeps the connection open, otherwise close it
+        """
+        if self.response is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, self.connection)
+        else:
+            self.connection.close()
+        self.response = None
+        self.connection = None
+
+    def close(self):
+
+        if self.response is not None and not self.response.isclosed():
+            # the rest of the body would have to be read to reuse the
+            # connection
+            self.response.will_close = True
+        self.release()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+
+        self.close()
+
+
+class ConnectionPool(object):
+    """
+    Idle HTTP and HTTPS connections for each host that are reused
+    by later requests
+    """
+    def __init__(self, max_idle=MAX_IDLE, timeout=None):
+        """
+        *max_idle*: int
+            Maximum number of idle connections kept for each host
+
+        *timeout*: [ float | None ]
+            Socket timeout in seconds of new connections
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> list of idle connections
+        self.idle = {}
+        # number of connections created
+        self.created = 0
+
+    def get(self, key):
+        """
+        Return an idle connection to a host and whether it was reused
+
+        *key*: tuple
+            (scheme, host, port)
+        """
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+            self.created += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        if self.timeout is None:
+            return cls(host, port), False
+        return cls(host, port, timeout=self.timeout), False
+
+    def put(self, key, connection):
+        """
+        Keep an idle connection for later requests to the same host
+
+        *key*: tuple
+
+        *connection*: httplib.HTTPConnection
+        """
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def urlopen(self, url):
+        """
+        Send a GET request and return the Response. Redirects are followed.
+
+        *url*: str
+        """
+        for redirect in xrange(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError("unsupported URL: {0}".format(url))
+            key = (parts.scheme, parts.hostname,
+                   parts.port or (443 if parts.scheme == 'https' else 80))
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response, connection = self.__request(key, path)
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('location')
+                response.read()
+                Response(self, key, connection, response, url).release()
+                if location is None:
+                    raise IOError("HTTP {0:d} without a location: {1}".format(
+                        response.status, url))
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                Response(self, key, connection, response, url).release()
+                raise IOError("HTTP {0:d} {1}: {2}".format(
+                    response.status, response.reason, url))
+            return Response(self, key, connection, response, url)
+        raise IOError("too many redirects: {0}".format(url))
+
+    def __request(self, key, path):
+
+        while True:
+            connection, reused = self.get(key)
+            try:
+                connection.request('GET', path,
+                                   headers={'Connection': 'keep-alive'})
+                return connection.getresponse(), connection
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # the server may have closed an idle connection
+                # so only retry with a new connection
+                if not reused:
+                    raise
+
+
+_POOL = ConnectionPool()
+
+
+def urlopen(url):
+    """
+    Open a URL with a connection from the shared pool. The proxies of the
+    environment are used through urllib2 instead if one is set for the URL.
+
+    *url*: str
+    """
+    import urllib
+    parts = urlparse.urlsplit(url)
+    if (parts.scheme in urllib.getproxies() and
+            not urllib.proxy_bypass(parts.hostname)):
+        import urllib2
+        return urllib2.urlopen(url)
+    return _POOL.urlopen(url)
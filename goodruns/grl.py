@@ -9,21 +9,14 @@ from . import info
 import sys
 import os
 import copy
-import urllib2
-from pprint import pprint
 from operator import sub, or_, and_, xor, itemgetter
 from .sorteddict import SortedDict
 import bisect
-import datetime
-import cStringIO
+import heapq
+import struct
+import time
 import re
-import xml.etree.ElementTree as _ET
-
-try:
-    import yaml
-    USE_YAML = True
-except ImportError:
-    USE_YAML = False
+from itertools import chain, izip, islice
 
 
 __all__ = [
@@ -32,8 +25,16 @@ __all__ = [
     'ored',
     'anded',
     'xored',
+    'load_many',
+    'open_compressed',
     'LumiblockRange',
+    'LumiblockIndex',
+    'Metadata',
     'GRL',
+    'GRLPatch',
+    'enable_stats',
+    'disable_stats',
+    'get_stats',
 ]
 
 
@@ -79,6 +80,141 @@ def get_tree_builder():
     return _MetadataTreeBuilder()
 
 
+COMPRESSIONS = ('gz', 'bz2', 'xz')
+
+
+def _lzma():
+
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ImportError(
+                "xz compression requires the lzma module "
+                "(pip install backports.lzma)")
+    return lzma
+
+
+def split_compression(filename):
+    """
+    Return the filename without the compression extension and the
+    compression (gz, bz2, xz or None)
+
+    *filename*: str
+    """
+    name, ext = os.path.splitext(filename)
+    if ext[1:] in COMPRESSIONS:
+        return name, ext[1:]
+    return filename, None
+
+
+def _decompressor(compression):
+
+    if compression == 'gz':
+        import zlib
+        # expect a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+    if compression == 'xz':
+        return _lzma().LZMADecompressor()
+    raise ValueError("unknown compression: {0}".format(compression))
+
+
+class DecompressedFile(object):
+    """
+    A read-only file-like object that decompresses a gzip, bz2 or xz stream
+    from another file-like object while it is read, so that compressed files
+    and downloads are parsed without writing them out uncompressed first
+    """
+    def __init__(self, fileobj, compression, chunk_size=1 << 16):
+        """
+        *fileobj*: file
+            Any object with a read(size) method
+
+        *compression*: str
+            gz, bz2 or xz
+
+        *chunk_size*: int
+            Number of compressed bytes read at a time
+        """
+        self.fileobj = fileobj
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.name = getattr(fileobj, 'name', None)
+        self.decompressor = _decompressor(compression)
+        self.buffer = ''
+        self.eof = False
+
+    def __decompress(self, data):
+
+        chunks = [self.decompressor.decompress(data)]
+        # continue with the next stream of concatenated streams
+        while self.decompressor.unused_data:
+            data = self.decompressor.unused_data
+            self.decompressor = _decompressor(self.compression)
+            chunks.append(self.decompressor.decompress(data))
+        return ''.join(chunks)
+
+    def read(self, size=-1):
+        """
+        Read up to size decompressed bytes or all remaining bytes if size is
+        negative
+        """
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self.eof = True
+                if hasattr(self.decompressor, 'flush'):
+                    self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.__decompress(data)
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+
+        self.fileobj.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+
+        self.close()
+
+
+def open_compressed(filename, mode='r'):
+    """
+    Open a file that is compressed according to its extension
+    (.gz, .bz2 or .xz) or an uncompressed file otherwise
+
+    *filename*: str
+
+    *mode*: str
+        r or w
+    """
+    compression = split_compression(filename)[1]
+    if compression is None:
+        return open(filename, mode)
+    if mode.startswith('r'):
+        return DecompressedFile(open(filename, 'rb'), compression)
+    if compression == 'gz':
+        import gzip
+        return gzip.open(filename, 'wb')
+    if compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(filename, 'w')
+    return _lzma().LZMAFile(filename, 'w')
+
+
 def clipped(grl, startrun=None, startlb=None, endrun=None, endlb=None):
     """
     Return a clipped GRL between startrun, startlb and
@@ -136,6 +272,493 @@ def xored(*args):
     return reduce(xor, args)
 
 
+def load_many(sources, limit=8, return_exceptions=False, **kwargs):
+    """
+    Load GRLs from many sources with up to limit sources read at the same time
+    so that network and file I/O overlap. Return the list of GRLs in the same
+    order as the sources. GRLs in ROOT files are read one at a time in the
+    calling thread since ROOT is not thread-safe.
+
+    *sources*: iterable
+        Anything accepted by GRL()
+
+    *limit*: int
+        Maximum number of sources read at the same time
+
+    *return_exceptions*: bool
+        If True, the exception raised while loading a source is returned in
+        place of its GRL. Otherwise the first exception in the order of the
+        sources is raised after all sources are loaded.
+
+    *kwargs*: dict
+        Additional arguments passed to GRL()
+    """
+    import threading
+    import Queue
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    sources = list(sources)
+    results = [None] * len(sources)
+    errors = [None] * len(sources)
+
+    def load(index):
+        try:
+            results[index] = GRL(sources[index], **kwargs)
+        except Exception:
+            errors[index] = sys.exc_info()
+
+    queue = Queue.Queue()
+    root_sources = []
+    for index, source in enumerate(sources):
+        if (isinstance(source, basestring) and
+                re.search(GRL.ROOT_PATTERN, source)):
+            root_sources.append(index)
+        else:
+            queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            load(index)
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(limit, queue.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for index in root_sources:
+        load(index)
+    for thread in threads:
+        thread.join()
+    for index, error in enumerate(errors):
+        if error is None:
+            continue
+        if not return_exceptions:
+            raise error[0], error[1], error[2]
+        results[index] = error[1]
+    return results
+
+
+_YAML_LOADER = None
+
+
+def _yaml_loader():
+    """
+    Return the fastest safe YAML loader that also accepts the python/tuple
+    tags written by earlier versions of goodruns
+    """
+    global _YAML_LOADER
+    if _YAML_LOADER is None:
+        try:
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+
+        class Loader(SafeLoader):
+            pass
+
+        Loader.add_constructor(
+            u'tag:yaml.org,2002:python/tuple',
+            lambda loader, node: loader.construct_sequence(node))
+        _YAML_LOADER = Loader
+    return _YAML_LOADER
+
+
+def merged_lbranges(lbranges):
+    """
+    Return a sorted list of LumiblockRanges where overlapping and adjacent
+    (start, end) pairs are merged
+
+    *lbranges*: iterable
+        iterable of (start, end) pairs of integers in any order
+    """
+    merged = []
+    for start, end in sorted(lbranges):
+        if not (isinstance(start, (int, long)) and
+                isinstance(end, (int, long))):
+            raise TypeError("lbrange must contain integers or longs only")
+        if start > end:
+            raise ValueError(
+                "lbrange in wrong order: {0}".format(((start, end),)))
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    # the ranges are valid by construction
+    return [tuple.__new__(LumiblockRange, lbrange) for lbrange in merged]
+
+
+def _boundaries(lbranges, which):
+    """
+    Yield (lumiblock, which) where each lumiblock range of a sorted list of
+    lumiblock ranges starts and where it ends (exclusive)
+    """
+    for lbrange in lbranges:
+        yield lbrange[0], which
+        yield lbrange[1] + 1, which
+
+
+def delta_lbranges(old, new):
+    """
+    Return the lists of lumiblock ranges (added, removed) that are only in
+    new and only in old in a single linear merge of both lists
+
+    *old*: list
+        sorted list of non-overlapping lumiblock ranges
+
+    *new*: list
+        sorted list of non-overlapping lumiblock ranges
+    """
+    added = []
+    removed = []
+    inside = [False, False]
+    last = None
+    for lbn, which in heapq.merge(_boundaries(old, 0), _boundaries(new, 1)):
+        if lbn != last and last is not None and inside[0] != inside[1]:
+            # [last, lbn - 1] is only in one of the lists
+            lbranges = removed if inside[0] else added
+            if lbranges and lbranges[-1][1] == last - 1:
+                lbranges[-1][1] = lbn - 1
+            else:
+                lbranges.append([last, lbn - 1])
+        inside[which] = not inside[which]
+        last = lbn
+    return ([tuple.__new__(LumiblockRange, lbrange) for lbrange in added],
+            [tuple.__new__(LumiblockRange, lbrange) for lbrange in removed])
+
+
+def sourced_lbranges(lists):
+    """
+    Return the list of (LumiblockRange, mask) covered by at least one of
+    several lists of lumiblock ranges in a single sweep over the starts and
+    ends of all ranges. The ranges are split wherever a range of any list
+    starts or ends and bit i of mask is set if list i contains the range.
+
+    *lists*: list
+        lists of sorted and non-overlapping lumiblock ranges
+    """
+    n = len(lists)
+    # encode each start and end (exclusive) as lbn * n + i so that a single
+    # sort of ints orders them by lumiblock
+    bounds = []
+    for i, lbranges in enumerate(lists):
+        for start, end in lbranges:
+            bounds.append(start * n + i)
+            bounds.append((end + 1) * n + i)
+    bounds.sort()
+    new = tuple.__new__
+    sourced = []
+    mask = 0
+    last = None
+    for bound in bounds:
+        lbn, i = divmod(bound, n)
+        if lbn != last and mask:
+            # [last, lbn - 1] is contained by the same lists
+            sourced.append((new(LumiblockRange, (last, lbn - 1)), mask))
+        # the ranges of a list do not overlap so each of its starts and
+        # ends toggles its bit
+        mask ^= 1 << i
+        last = lbn
+    return sourced
+
+
+# combine runs as bitmaps when they contain at least this many lumiblock
+# ranges and span at most BITMAP_MAX_SPAN lumiblocks per lumiblock range
+BITMAP_MIN_RANGES = 8
+BITMAP_MAX_SPAN = 32
+
+BITS_ONES = re.compile('1+')
+
+# maximum number of lines shown by GRL.__repr__
+REPR_MAX_LINES = 100
+
+# the lumiblocks kept by each set operation as a function of whether they are
+# in the first and second list of lumiblock ranges, and the same operation on
+# bitmaps
+LBRANGE_OPS = {
+    'and': (lambda first, second: first and second, and_),
+    'or': (lambda first, second: first or second, or_),
+    'xor': (lambda first, second: first != second, xor),
+    'sub': (lambda first, second: first and not second,
+            lambda first, second: first & ~second),
+}
+
+
+def lbranges_to_bits(lbranges, offset=0):
+    """
+    Return an integer with the bits set for the lumiblocks in a list of
+    lumiblock ranges where bit 0 is the lumiblock offset
+
+    *lbranges*: list
+        sorted list of non-overlapping lumiblock ranges
+
+    *offset*: int
+    """
+    if not lbranges:
+        return 0
+    # set the binary digits in one pass and convert them once since ORing
+    # each range into a growing long is quadratic in the span
+    digits = bytearray('0') * (lbranges[-1][1] - offset + 1)
+    for start, end in lbranges:
+        digits[start - offset:end - offset + 1] = '1' * (end - start + 1)
+    digits.reverse()
+    return int(str(digits), 2)
+
+
+def bits_to_lbranges(bits, offset=0):
+    """
+    Return the sorted list of lumiblock ranges of the bits set in an integer
+    where bit 0 is the lumiblock offset
+
+    *bits*: int
+
+    *offset*: int
+    """
+    # binary digits in order of increasing lumiblock
+    digits = bin(bits)[:1:-1]
+    return [tuple.__new__(LumiblockRange,
+                          (match.start() + offset, match.end() - 1 + offset))
+            for match in BITS_ONES.finditer(digits)]
+
+
+def combine_lbranges(first, second, op):
+    """
+    Return a new sorted list of lumiblock ranges from a set operation between
+    two sorted lists of non-overlapping lumiblock ranges. Highly fragmented
+    runs are combined as bitmaps with one bitwise operation and other runs
+    with a linear merge of the range boundaries.
+
+    *first*: list
+
+    *second*: list
+
+    *op*: str
+        One of and, or, xor or sub
+    """
+    keep, bitwise = LBRANGE_OPS[op]
+    if not second:
+        return list(first) if keep(True, False) else []
+    if not first:
+        return list(second) if keep(False, True) else []
+    nranges = len(first) + len(second)
+    if nranges >= BITMAP_MIN_RANGES:
+        offset = min(first[0][0], second[0][0])
+        span = max(first[-1][1], second[-1][1]) - offset + 1
+        if span <= BITMAP_MAX_SPAN * nranges:
+            return bits_to_lbranges(bitwise(
+                lbranges_to_bits(first, offset),
+                lbranges_to_bits(second, offset)), offset)
+    lbranges = []
+    inside = [False, False]
+    last = None
+    for lbn, which in heapq.merge(_boundaries(first, 0),
+                                  _boundaries(second, 1)):
+        if lbn != last and last is not None and keep(*inside):
+            if lbranges and lbranges[-1][1] == last - 1:
+                lbranges[-1][1] = lbn - 1
+            else:
+                lbranges.append([last, lbn - 1])
+        inside[which] = not inside[which]
+        last = lbn
+    return [tuple.__new__(LumiblockRange, lbrange) for lbrange in lbranges]
+
+
+def lbranges_issubset(first, second):
+    """
+    Return True if all lumiblocks in a sorted list of non-overlapping
+    lumiblock ranges are in another, stopping at the first missing lumiblock
+
+    *first*: list
+
+    *second*: list
+    """
+    j = 0
+    nsecond = len(second)
+    for start, end in first:
+        while j < nsecond and second[j][1] < start:
+            j += 1
+        # merged ranges are separated by at least one lumiblock
+        # so each range must be inside a single range of second
+        if j == nsecond or second[j][0] > start or second[j][1] < end:
+            return False
+    return True
+
+
+def lbranges_overlap_size(first, second, stop=False):
+    """
+    Return the number of lumiblocks in both of two sorted lists of
+    non-overlapping lumiblock ranges
+
+    *first*: list
+
+    *second*: list
+
+    *stop*: bool
+        If True, return as soon as an overlap is found
+    """
+    i = j = 0
+    size = 0
+    nfirst = len(first)
+    nsecond = len(second)
+    while i < nfirst and j < nsecond:
+        start = max(first[i][0], second[j][0])
+        end = min(first[i][1], second[j][1])
+        if start <= end:
+            size += end - start + 1
+            if stop:
+                return size
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return size
+
+
+def _pack_ints(values):
+    """
+    Pack a sequence of integers into a string of 32-bit integers if they all
+    fit and 64-bit integers otherwise. The first character is the struct
+    format of the integers.
+    """
+    values = list(values)
+    if values and not (-(1 << 31) <= min(values) and max(values) < (1 << 31)):
+        code = 'q'
+    else:
+        code = 'i'
+    return code + struct.pack('<{0:d}{1}'.format(len(values), code), *values)
+
+
+def _unpack_ints(data):
+    """
+    Return the tuple of integers packed by _pack_ints
+    """
+    code = data[0]
+    count = (len(data) - 1) // struct.calcsize(code)
+    return struct.unpack_from('<{0:d}{1}'.format(count, code), data, 1)
+
+
+def _lbrange(start, end):
+    """
+    Create a LumiblockRange without validating it when unpickling
+    """
+    return tuple.__new__(LumiblockRange, (start, end))
+
+
+def _encode_keys(np, runs, starts, ends):
+    """
+    Validate arrays of run numbers, starts and ends of lumiblock ranges and
+    return the arrays of the encoded starts and ends (see runlb_key)
+    """
+    runs = np.asarray(runs)
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    if not (runs.ndim == starts.ndim == ends.ndim == 1):
+        raise ValueError("runs, starts and ends must be 1-dimensional")
+    if not (len(runs) == len(starts) == len(ends)):
+        raise ValueError("runs, starts and ends must have the same length")
+    if not len(runs):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    for array in (runs, starts, ends):
+        if array.dtype.kind not in 'iu':
+            raise TypeError("runs, starts and ends must be integers")
+    if np.any(starts > ends):
+        raise ValueError("lbrange in wrong order")
+    if (runs.min() < 0 or starts.min() < 0 or
+            ends.max() > LB_MASK or runs.max() >= 1 << (63 - LB_BITS)):
+        raise ValueError("run or lumiblock number out of range")
+    runs = runs.astype(np.int64) << LB_BITS
+    return runs | starts.astype(np.int64), runs | ends.astype(np.int64)
+
+
+def _merge_keys(np, start_keys, end_keys):
+    """
+    Sort encoded lumiblock ranges and merge the overlapping and adjacent
+    ranges in the same run. Return the arrays of the merged starts and ends.
+    """
+    if not len(start_keys):
+        return start_keys, end_keys
+    order = np.lexsort((end_keys, start_keys))
+    start_keys = start_keys[order]
+    end_keys = np.maximum.accumulate(end_keys[order])
+    # a merged range starts where a range neither overlaps nor is
+    # adjacent to all previous ranges in the same run
+    first = np.empty(len(start_keys), dtype=bool)
+    first[0] = True
+    first[1:] = ((start_keys[1:] > end_keys[:-1] + 1) |
+                 ((start_keys[1:] >> LB_BITS) != (end_keys[:-1] >> LB_BITS)))
+    first = np.flatnonzero(first)
+    last = np.append(first[1:], len(start_keys)) - 1
+    return start_keys[first], end_keys[last]
+
+
+class Metadata(object):
+    """
+    A Metadata element of a GRL in XML format stored as its raw XML. The XML
+    is only parsed when the text or attributes of the element are accessed
+    and is written verbatim by GRL.write().
+    """
+    def __init__(self, name, raw):
+        """
+        *name*: str
+            Value of the Name attribute
+
+        *raw*: str
+            XML of the Metadata element
+        """
+        self.name = name
+        self.raw = raw
+        self._element = None
+
+    @classmethod
+    def from_element(cls, element):
+        """
+        Create Metadata from an ElementTree or lxml element
+
+        *element*: Element
+        """
+        # do not keep the whitespace following the element
+        element.tail = None
+        if info.USE_LXML:
+            import lxml.etree as ET
+        else:
+            import xml.etree.ElementTree as ET
+        return cls(element.get('Name'), ET.tostring(element, encoding='utf-8'))
+
+    @property
+    def element(self):
+        """
+        The parsed Metadata element
+        """
+        if self._element is None:
+            import xml.etree.ElementTree as ET
+            self._element = ET.fromstring(self.raw)
+        return self._element
+
+    def __getattr__(self, attr):
+
+        # provide text, attrib, get() etc. of the element
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.element, attr)
+
+    def __getstate__(self):
+
+        return self.name, self.raw
+
+    def __setstate__(self, state):
+
+        self.name, self.raw = state
+        self._element = None
+
+    def __repr__(self):
+
+        return 'Metadata({0!r}, {1!r})'.format(self.name, self.raw)
+
+
 class LumiblockRange(tuple):
     """
     A 2-tuple consisting of the lower and upper
@@ -198,6 +821,10 @@ class LumiblockRange(tuple):
         """
         return set(range(self[0], self[1] + 1))
 
+    def __reduce__(self):
+
+        return _lbrange, (self[0], self[1])
+
 
 class GRL(object):
     """
@@ -207,6 +834,7 @@ class GRL(object):
     formats = [
         'xml',
         'yml',
+        'json',
         'txt',
         'py',
         'cut'
@@ -214,12 +842,21 @@ class GRL(object):
 
     ROOT_PATTERN = re.compile(r'\.root[^ \t\n\r\f\v:/]*:/')
 
-    def __init__(self, grl=None, from_string=False, format=None):
+    def __init__(self, grl=None, from_string=False, format=None,
+                 metadata=True):
         """
         *grl*: [ dict | str | None ]
 
         *from_string*: bool
             If True, interpret grl as xml string and not filename
+
+        *format*: [ str | None ]
+            xml, yml or json. Otherwise infer the format from the
+            file extension.
+
+        *metadata*: bool
+            If False, do not keep the XML Metadata elements to reduce
+            memory usage
         """
         self.name = 'GRL'
         self.version = '1.0'
@@ -231,17 +868,21 @@ class GRL(object):
             self.from_dict(grl)
             return
         if isinstance(grl, basestring) and from_string:
-            self.from_string(grl)
+            self.from_string(grl, format=format or 'xml', metadata=metadata)
             return
         elif from_string:
             raise TypeError("grl is non-string type '{0}' while "
                             "using from_string=True".format(type(grl)))
         elif isinstance(grl, (basestring, file)):
             filename = grl
+            opened = None
             if isinstance(grl, basestring):
                 # is grl a URL?
                 if re.match('^http(s)?://', grl) is not None:
-                    grl = urllib2.urlopen(grl)
+                    # reuse connections to the same host and
+                    # parse the GRL while it is downloaded
+                    from .fetch import urlopen
+                    grl = opened = urlopen(grl)
                 # is grl a ROOT file path?
                 elif re.search(self.ROOT_PATTERN, grl):
                     # one place where goodruns requires ROOT
@@ -267,7 +908,8 @@ class GRL(object):
                         raise TypeError(
                             "Object at {0} is not a ROOT.TObjString".format(
                                 path))
-                    self.from_string(str(grl.GetString()))
+                    self.from_string(str(grl.GetString()),
+                                     metadata=metadata)
                     root_file.Close()
                     # return to previous directory
                     cwd.cd()
@@ -277,32 +919,45 @@ class GRL(object):
                     return
             elif isinstance(grl, file):
                 filename = grl.name
-            name, ext = os.path.splitext(filename)
-            if filename == '<stdin>' or ext == '.xml' or format == 'xml':
-                if info.USE_LXML:
-                    import lxml.etree as ET
-                else:
-                    import xml.etree.ElementTree as ET
-                if sys.version_info >= (2, 7):
-                    tree = ET.parse(
-                        grl, parser=ET.XMLParser(
-                        target=get_tree_builder()))
-                else:
-                    tree = ET.parse(grl)
-                self.from_xml(tree)
-            elif ext == '.yml' or format == 'yml':
-                if USE_YAML:
-                    if isinstance(grl, file):
-                        self.from_dict(yaml.load(grl))
+            # decompress .gz, .bz2 and .xz files and downloads while parsing
+            filename, compression = split_compression(filename)
+            if compression is not None:
+                if isinstance(grl, basestring):
+                    grl = opened = open(grl, 'rb')
+                grl = DecompressedFile(grl, compression)
+                if opened is not None:
+                    opened = grl
+            try:
+                name, ext = os.path.splitext(filename)
+                if filename == '<stdin>' or ext == '.xml' or format == 'xml':
+                    if info.USE_LXML:
+                        import lxml.etree as ET
+                    else:
+                        import xml.etree.ElementTree as ET
+                    if sys.version_info >= (2, 7):
+                        tree = ET.parse(
+                            grl, parser=ET.XMLParser(
+                            target=get_tree_builder()))
+                    else:
+                        tree = ET.parse(grl)
+                    self.from_xml(tree, metadata=metadata)
+                elif ext in ('.yml', '.json') or format in ('yml', 'json'):
+                    if format is None:
+                        format = ext[1:]
+                    if hasattr(grl, 'read'):
+                        self.from_string(grl.read(), format=format)
                     else:
                         with open(grl) as grl_file:
-                            self.from_dict(yaml.load(grl_file))
+                            self.from_string(grl_file.read(), format=format)
+                    return
                 else:
-                    raise ImportError("PyYAML module not found")
-            else:
-                raise ValueError(
-                    "{0} does not have valid GRL extension: {1}".format(
-                        filename, ext))
+                    raise ValueError(
+                        "{0} does not have valid GRL extension: {1}".format(
+                            filename, ext))
+            finally:
+                # close the files and responses opened here
+                if opened is not None:
+                    opened.close()
             for run in self.iterruns():
                 self.__grl[run].sort()
                 self.__optimize(run)
@@ -310,12 +965,37 @@ class GRL(object):
         raise TypeError(
             "Unable to initialize GRL from a '{0}'".format(type(grl)))
 
-    def from_string(self, string):
+    def from_string(self, string, format='xml', metadata=True):
         """
-        Insert runs and lumiblocks from XML string
+        Insert runs and lumiblocks from a string
 
         *string*: str
+
+        *format*: str
+            xml, yml or json
+
+        *metadata*: bool
+            If False, do not keep the XML Metadata elements
         """
+        if format in ('yml', 'yaml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML module not found")
+            self.__insert_lbranges(yaml.load(string, Loader=_yaml_loader()))
+            return
+        if format == 'json':
+            import json
+            lbranges = json.loads(string)
+            if not isinstance(lbranges, dict):
+                raise ValueError("JSON GRL must be an object mapping runs "
+                                 "to lists of lumiblock ranges")
+            self.__insert_lbranges(dict(
+                (int(run), run_lbranges)
+                for run, run_lbranges in lbranges.iteritems()))
+            return
+        if format != 'xml':
+            raise ValueError("Unrecognized grl format")
         if info.USE_LXML:
             import lxml.etree as ET
         else:
@@ -326,13 +1006,16 @@ class GRL(object):
         else:
             tree = ET.fromstring(string)
 
-        self.from_xml(tree)
+        self.from_xml(tree, metadata=metadata)
 
-    def from_xml(self, tree):
+    def from_xml(self, tree, metadata=True):
         """
         Insert runs and lumiblocks from XML
 
         *tree*: ElementTree
+
+        *metadata*: bool
+            If False, do not keep the Metadata elements
         """
         name = tree.find('NamedLumiRange/Name')
         if name is not None:
@@ -340,9 +1023,9 @@ class GRL(object):
         version = tree.find('NamedLumiRange/Version')
         if version is not None:
             self.version = version.text
-        metadata = tree.findall('NamedLumiRange/Metadata')
-        if metadata is not None:
-            self.metadata = metadata
+        if metadata:
+            self.metadata = [Metadata.from_element(element) for element in
+                             tree.findall('NamedLumiRange/Metadata')]
         lbcols = tree.findall(
             'NamedLumiRange/LumiBlockCollection')
         if lbcols is None:
@@ -355,6 +1038,29 @@ class GRL(object):
                     LumiblockRange(int(lumiblock.attrib['Start']),
                                    int(lumiblock.attrib['End'])))
 
+    def __insert_lbranges(self, d):
+        """
+        Insert runs and lumiblocks from a dict mapping runs to lists of
+        (start, end) pairs. The pairs of each run are sorted and merged in a
+        single pass without validating each one with LumiblockRange.
+
+        *d*: dict
+        """
+        if d is None:
+            return
+        if not isinstance(d, dict):
+            raise ValueError("GRL must map runs to lists of lumiblock ranges")
+        o = {}
+        for run, lbranges in d.iteritems():
+            if not isinstance(run, (int, long)):
+                raise TypeError("run must be an integer or long")
+            if run in self.__grl:
+                lbranges = list(self.__grl[run]) + list(lbranges)
+            lbranges = merged_lbranges(lbranges)
+            if lbranges:
+                o[run] = lbranges
+        self.__grl.update(o)
+
     def from_dict(self, d):
         """
         Convert dict to GRL
@@ -363,7 +1069,9 @@ class GRL(object):
         """
         o = {}
         for run, lbranges in d.items():
-            o[run] = [LumiblockRange(*a) for a in lbranges]
+            lbranges = merged_lbranges(LumiblockRange(*a) for a in lbranges)
+            if lbranges:
+                o[run] = lbranges
         self.__grl.update(o)
 
     def to_dict(self):
@@ -375,6 +1083,196 @@ class GRL(object):
             o[run] = [(a[0], a[1]) for a in lbranges]
         return o
 
+    def to_arrays(self, dtype='int64'):
+        """
+        Return three numpy arrays of the run numbers, starts and ends of all
+        lumiblock ranges in ascending order. Requires numpy.
+
+        *dtype*: numpy dtype
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("GRL.to_arrays requires numpy")
+        counts = [len(lbranges) for lbranges in self.__grl.itervalues()]
+        size = sum(counts)
+        runs = np.repeat(np.array(self.__grl.keys(), dtype=dtype), counts)
+        bounds = np.fromiter(
+            chain.from_iterable(chain.from_iterable(self.__grl.itervalues())),
+            dtype=dtype, count=2 * size).reshape(size, 2)
+        return runs, bounds[:, 0].copy(), bounds[:, 1].copy()
+
+    def to_shared(self, dir=None):
+        """
+        Return a read-only goodruns.shared.SharedGRL copy of this GRL in
+        shared memory that is pickled as a small handle. Close and unlink it
+        when it is no longer needed, e.g. with a with statement.
+
+        *dir*: [ str | None ]
+            Directory of the shared file (default: /dev/shm if it exists,
+            otherwise the temporary directory)
+        """
+        from .shared import SharedGRL
+        return SharedGRL.create(self, dir=dir)
+
+    @classmethod
+    def from_arrays(cls, runs, starts, ends):
+        """
+        Create a GRL from arrays of run numbers, starts and ends of lumiblock
+        ranges in any order. Overlapping and adjacent ranges are merged with
+        vectorized operations. Requires numpy.
+
+        *runs*: array_like
+
+        *starts*: array_like
+
+        *ends*: array_like
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("GRL.from_arrays requires numpy")
+        start_keys, end_keys = _merge_keys(
+            np, *_encode_keys(np, runs, starts, ends))
+        return cls.__from_keys(start_keys, end_keys)
+
+    @classmethod
+    def from_events(cls, runs, lbs=None):
+        """
+        Create a GRL of the lumiblocks containing events from arrays of the
+        run and lumiblock numbers of each event. Duplicate lumiblocks are
+        removed and consecutive lumiblocks are merged into ranges.
+        Requires numpy.
+
+        To limit memory usage, runs may instead be an iterable of
+        (runs, lbs) chunks of arrays and lbs must then be None.
+        Only one chunk and about twice the merged ranges are held in
+        memory at a time.
+
+        *runs*: [ array_like | iterable ]
+
+        *lbs*: [ array_like | None ]
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("GRL.from_events requires numpy")
+        if lbs is None:
+            chunks = runs
+        else:
+            chunks = [(runs, lbs)]
+        start_keys = np.empty(0, dtype=np.int64)
+        end_keys = np.empty(0, dtype=np.int64)
+        # ranges of the chunks not merged yet. They are merged once they
+        # outnumber the merged ranges so each range is only sorted a few
+        # times instead of once per chunk.
+        pending_starts = []
+        pending_ends = []
+        pending = 0
+        for chunk_runs, chunk_lbs in chunks:
+            keys = np.unique(_encode_keys(
+                np, chunk_runs, chunk_lbs, chunk_lbs)[0])
+            if not len(keys):
+                continue
+            # run-length encode consecutive lumiblocks in the same run
+            first = np.empty(len(keys), dtype=bool)
+            first[0] = True
+            first[1:] = (((keys[1:] - keys[:-1]) != 1) |
+                         ((keys[1:] >> LB_BITS) != (keys[:-1] >> LB_BITS)))
+            first = np.flatnonzero(first)
+            last = np.append(first[1:], len(keys)) - 1
+            pending_starts.append(keys[first])
+            pending_ends.append(keys[last])
+            pending += len(first)
+            if pending >= len(start_keys):
+                start_keys, end_keys = _merge_keys(
+                    np,
+                    np.concatenate([start_keys] + pending_starts),
+                    np.concatenate([end_keys] + pending_ends))
+                pending_starts, pending_ends, pending = [], [], 0
+        if pending:
+            start_keys, end_keys = _merge_keys(
+                np,
+                np.concatenate([start_keys] + pending_starts),
+                np.concatenate([end_keys] + pending_ends))
+        return cls.__from_keys(start_keys, end_keys)
+
+    @classmethod
+    def from_normalized(cls, d):
+        """
+        Create a GRL from a dict mapping runs to lists of LumiblockRanges
+        that are already sorted and merged, e.g. read from a trusted cache,
+        without validating or merging them again
+
+        *d*: dict
+        """
+        grl = cls()
+        grl.__grl = SortedDict(d)
+        return grl
+
+    @classmethod
+    def __from_keys(cls, start_keys, end_keys):
+        """
+        Create a GRL from sorted arrays of the encoded starts and ends of
+        merged lumiblock ranges (see runlb_key)
+        """
+        import numpy as np
+        grl = cls()
+        if not len(start_keys):
+            return grl
+        runs = start_keys >> LB_BITS
+        starts = (start_keys & LB_MASK).tolist()
+        ends = (end_keys & LB_MASK).tolist()
+        # split the ranges by run
+        run_first = np.flatnonzero(np.append(True, runs[1:] != runs[:-1]))
+        run_last = np.append(run_first[1:], len(runs))
+        new = tuple.__new__
+        d = {}
+        for run, i, j in zip(runs[run_first].tolist(),
+                             run_first.tolist(), run_last.tolist()):
+            d[run] = [new(LumiblockRange, lbrange) for lbrange in
+                      zip(starts[i:j], ends[i:j])]
+        grl.__grl = SortedDict(d)
+        return grl
+
+    @classmethod
+    def union_with_sources(cls, grls, labels=None):
+        """
+        Return the OR of several GRLs as a list of (run, lbrange, sources)
+        computed in one pass over all GRLs. The lumiblock ranges are split
+        wherever a range of any GRL starts or ends, so each range is
+        contained by exactly the GRLs in its sources.
+
+        *grls*: list of GRLs
+
+        *labels*: [ list | None ]
+            Label of each GRL. If None, sources is an int where bit i is set
+            if GRL i contains the range, otherwise the tuple of the labels of
+            the GRLs containing the range.
+        """
+        if labels is not None and len(labels) != len(grls):
+            raise ValueError("need one label for each GRL")
+        runs = set()
+        for grl in grls:
+            runs.update(grl.__grl)
+        # the tuple of labels of each mask
+        sources = {}
+        table = []
+        for run in sorted(runs):
+            for lbrange, mask in sourced_lbranges(
+                    [grl.__grl.get(run, ()) for grl in grls]):
+                if labels is None:
+                    table.append((run, lbrange, mask))
+                    continue
+                try:
+                    labelled = sources[mask]
+                except KeyError:
+                    labelled = sources[mask] = tuple(
+                        label for i, label in enumerate(labels)
+                        if mask >> i & 1)
+                table.append((run, lbrange, labelled))
+        return table
+
     def __merge_metadata(self, other=None):
 
         # drop metadata for now
@@ -384,33 +1282,75 @@ class GRL(object):
 
         return copy.deepcopy(self)
 
+    def __getstate__(self):
+        """
+        Pack the runs, the number of lumiblock ranges in each run and the
+        bounds of all lumiblock ranges into strings of integers instead of
+        pickling one LumiblockRange per lumiblock range
+        """
+        attrs = dict(self.__dict__)
+        del attrs['_GRL__grl']
+        lbranges = self.__grl.values()
+        return (attrs,
+                _pack_ints(self.__grl.iterkeys()),
+                _pack_ints(len(run_lbranges) for run_lbranges in lbranges),
+                _pack_ints(chain.from_iterable(chain.from_iterable(lbranges))))
+
+    def __setstate__(self, state):
+
+        if isinstance(state, dict):
+            # pickled by goodruns before the lumiblock ranges were packed
+            self.__dict__.update(state)
+            return
+        attrs, runs, counts, bounds = state
+        self.__dict__.update(attrs)
+        bounds = iter(_unpack_ints(bounds))
+        # the lumiblock ranges were valid and merged when pickled
+        lbranges = [tuple.__new__(LumiblockRange, lbrange)
+                    for lbrange in izip(bounds, bounds)]
+        d = {}
+        first = 0
+        for run, count in izip(_unpack_ints(runs), _unpack_ints(counts)):
+            d[run] = lbranges[first:first + count]
+            first += count
+        self.__grl = SortedDict(d)
+
     def __nonzero__(self):
 
         return bool(self.__grl)
 
     def __repr__(self):
 
-        return self.__str__()
+        # only show the beginning of large GRLs
+        lines = list(islice(self.iter_text_lines(), REPR_MAX_LINES + 1))
+        if len(lines) > REPR_MAX_LINES:
+            lines[REPR_MAX_LINES:] = [
+                '... ({0:d} runs and {1:d} lumiblock ranges in total)'.format(
+                    len(self.__grl), sum(len(lbranges) for lbranges in
+                                         self.__grl.itervalues()))]
+        return '\n'.join(lines)
 
     def __str__(self):
 
-        output = ''
-        runs_end = len(self.__grl) - 1
-        for i, run in enumerate(self.iterruns()):
-            lbranges = self.__grl[run]
+        return '\n'.join(self.iter_text_lines())
+
+    def iter_text_lines(self):
+        """
+        Iterate over the lines (without line endings) of the text
+        representation of the GRL
+        """
+        for run, lbranges in self.__grl.iteritems():
             maxlength = max([len(str(lbrange[0])) for lbrange in lbranges])
-            output += '-' * 15 + '\n'
-            output += 'RUN: %i\n' % run
-            output += 'LUMIBLOCKS:\n'
-            lbranges_end = len(lbranges) - 1
-            for j, lbrange in enumerate(lbranges):
+            single = '  %%-%ds' % maxlength
+            double = single + ' - %i'
+            yield '-' * 15
+            yield 'RUN: %i' % run
+            yield 'LUMIBLOCKS:'
+            for lbrange in lbranges:
                 if lbrange[0] == lbrange[1]:
-                    output += ('  %%-%ds' % maxlength) % lbrange[0]
+                    yield single % lbrange[0]
                 else:
-                    output += ('  %%-%ds' % maxlength + ' - %i') % lbrange
-                if i != runs_end or j != lbranges_end:
-                    output += '\n'
-        return output
+                    yield double % lbrange
 
     def __getitem__(self, run):
         """
@@ -444,6 +1384,29 @@ class GRL(object):
                 return True
         return False
 
+    def contains_many(self, runlbs):
+        """
+        Return a list of bools, one for each (run, lumiblock) in runlbs,
+        that are True if this GRL contains the run and lumiblock
+
+        *runlbs*: iterable
+            iterable of 2-tuples of ints containing run number and
+            lumiblock number
+        """
+        # upper bounds of lumiblock ranges for each run queried so far
+        ends = {}
+        result = []
+        for run, lbn in runlbs:
+            try:
+                run_ends = ends[run]
+            except KeyError:
+                run_ends = ends[run] = [lbrange[1] for lbrange in
+                                        self.__grl.get(run, ())]
+            i = bisect.bisect_left(run_ends, lbn)
+            result.append(i != len(run_ends) and
+                          self.__grl[run][i][0] <= lbn)
+        return result
+
     def __iter__(self):
         """
         Iterate over runs in GRL
@@ -497,13 +1460,19 @@ class GRL(object):
             raise TypeError('run must be an integer')
         if not isinstance(lbrange, LumiblockRange):
             lbrange = LumiblockRange(*lbrange)
-        try:
-            lbranges = self.__grl[run]
-            i = bisect.bisect(lbranges, lbrange)
-            lbranges.insert(i, lbrange)
-            self.__optimize(run)
-        except KeyError:
+        lbranges = self.__grl.get(run)
+        if lbranges is None:
             self.__grl[run] = [lbrange]
+            return
+        start, end = lbrange
+        # lbranges[first:last] overlap or are adjacent to lbrange
+        first = bisect.bisect_left(lbranges, start - 1)
+        last = bisect.bisect_right(lbranges, end + 1)
+        if first < last:
+            start = min(start, lbranges[first][0])
+            end = max(end, lbranges[last - 1][1])
+            lbrange = tuple.__new__(LumiblockRange, (start, end))
+        lbranges[first:last] = [lbrange]
 
     def remove(self, run, lbrange):
         """
@@ -517,33 +1486,21 @@ class GRL(object):
             if not isinstance(lbrange, LumiblockRange):
                 lbrange = LumiblockRange(*lbrange)
             lbranges = self.__grl[run]
-            for mylbrange in lbranges[:]:
-                if lbrange[1] < mylbrange[0]:
-                    continue
-                if lbrange == mylbrange:
-                    lbranges.remove(mylbrange)
-                    break
-                elif lbrange[0] > mylbrange[0] and lbrange[1] < mylbrange[1]:
-                    # embedded: must split
-                    left_lbrange = LumiblockRange(mylbrange[0],
-                                                  lbrange[0] - 1)
-                    right_lbrange = LumiblockRange(lbrange[1] + 1,
-                                                   mylbrange[1])
-                    index = lbranges.index(mylbrange)
-                    lbranges[index] = left_lbrange
-                    lbranges.insert(index + 1, right_lbrange)
-                    break
-                elif lbrange.intersects(mylbrange):
-                    diff = mylbrange.as_set().difference(lbrange.as_set())
-                    if not diff:  # empty set
-                        lbranges.remove(mylbrange)
-                        if len(lbranges) == 0:
-                            break
-                        continue
-                    newlbrange = LumiblockRange(min(diff), max(diff))
-                    lbranges[lbranges.index(mylbrange)] = newlbrange
-                elif mylbrange[0] > lbrange[1]:
-                    break
+            start, end = lbrange
+            # lbranges[first:last] overlap lbrange
+            first = bisect.bisect_left(lbranges, start)
+            last = bisect.bisect_right(lbranges, end)
+            if first == last:
+                return
+            # keep the parts of the first and last ranges outside lbrange
+            remaining = []
+            if lbranges[first][0] < start:
+                remaining.append(tuple.__new__(
+                    LumiblockRange, (lbranges[first][0], start - 1)))
+            if lbranges[last - 1][1] > end:
+                remaining.append(tuple.__new__(
+                    LumiblockRange, (end + 1, lbranges[last - 1][1])))
+            lbranges[first:last] = remaining
             if len(lbranges) == 0:
                 del self.__grl[run]
 
@@ -633,70 +1590,212 @@ class GRL(object):
 
         return not self.__eq__(other)
 
-    def __add__(self, other):
+    def issubset(self, other):
+        """
+        Return True if all runs and lumiblocks in this GRL are in another GRL
 
-        grlcopy = copy.deepcopy(self)
-        grlcopy += other
-        return grlcopy
+        *other*: GRL
+        """
+        theirs = other.__grl
+        for run, lbranges in self.__grl.iteritems():
+            if run not in theirs:
+                return False
+            if not lbranges_issubset(lbranges, theirs[run]):
+                return False
+        return True
+
+    def issuperset(self, other):
+        """
+        Return True if all runs and lumiblocks in another GRL are in this GRL
 
-    def __iadd__(self, other):
+        *other*: GRL
+        """
+        return other.issubset(self)
+
+    def isdisjoint(self, other):
+        """
+        Return True if this GRL and another GRL have no lumiblocks in common
+
+        *other*: GRL
+        """
+        mine, theirs = self.__grl, other.__grl
+        if len(theirs) < len(mine):
+            mine, theirs = theirs, mine
+        for run, lbranges in mine.iteritems():
+            if run in theirs and lbranges_overlap_size(
+                    lbranges, theirs[run], stop=True):
+                return False
+        return True
+
+    def overlap_size(self, other):
+        """
+        Return the number of lumiblocks in both this GRL and another GRL
+
+        *other*: GRL
+        """
+        mine, theirs = self.__grl, other.__grl
+        if len(theirs) < len(mine):
+            mine, theirs = theirs, mine
+        return sum(lbranges_overlap_size(lbranges, theirs[run])
+                   for run, lbranges in mine.iteritems() if run in theirs)
+
+    def __le__(self, other):
+
+        if not isinstance(other, GRL):
+            return NotImplemented
+        return self.issubset(other)
+
+    def __ge__(self, other):
+
+        if not isinstance(other, GRL):
+            return NotImplemented
+        return other.issubset(self)
+
+    def __lt__(self, other):
+
+        if not isinstance(other, GRL):
+            return NotImplemented
+        return len(self.__grl) <= len(other.__grl) and \
+            self.issubset(other) and self != other
 
+    def __gt__(self, other):
+
+        if not isinstance(other, GRL):
+            return NotImplemented
+        return other.__lt__(self)
+
+    def __combined_runs(self, other, op):
+        """
+        Return a new SortedDict of the lumiblock ranges of each run after a
+        set operation between this GRL and another GRL
+
+        *other*: [ GRL | str ]
+
+        *op*: str
+            One of and, or, xor or sub
+        """
         if isinstance(other, basestring):
             other = GRL(other, from_string=True)
-        for run, lbrange in other.iterlbranges():
-            self.insert(run, LumiblockRange(lbrange))
+        theirs = other.__grl
+        if op in ('and', 'sub'):
+            runs = self.__grl.iterkeys()
+        else:
+            runs = set(self.__grl) | set(theirs)
+        o = {}
+        for run in runs:
+            lbranges = combine_lbranges(self.__grl.get(run, ()),
+                                        theirs.get(run, ()), op)
+            if lbranges:
+                o[run] = lbranges
+        return SortedDict(o)
+
+    def __combined(self, other, op):
+
+        grl = GRL()
+        grl.name = self.name
+        grl.version = self.version
+        grl.__grl = self.__combined_runs(other, op)
+        return grl
+
+    def __combine(self, other, op):
+
+        self.__grl = self.__combined_runs(other, op)
         self.__merge_metadata(other)
         return self
 
+    def __add__(self, other):
+
+        return self.__combined(other, 'or')
+
+    def __iadd__(self, other):
+
+        return self.__combine(other, 'or')
+
     def __sub__(self, other):
 
-        grlcopy = copy.deepcopy(self)
-        grlcopy -= other
-        return grlcopy
+        return self.__combined(other, 'sub')
 
     def __isub__(self, other):
 
-        if isinstance(other, basestring):
-            other = GRL(other, from_string=True)
-        for run, lbrange in other.iterlbranges():
-            self.remove(run, lbrange)
-        self.__merge_metadata(other)
-        return self
+        return self.__combine(other, 'sub')
 
     def __and__(self, other):
         """ Create a new GRL that is the overlap between two GRLs
         """
-        return self - (self - other)
+        return self.__combined(other, 'and')
 
     def __iand__(self, other):
         """ Update this GRL by only including the overlap with another GRL
         """
-        self -= (self - other)
-        return self
+        return self.__combine(other, 'and')
 
     def __or__(self, other):
         """ Merge two GRLs
         """
-        return self + other
+        return self.__combined(other, 'or')
 
     def __ior__(self, other):
         """ Update this GRL by adding the logical OR with another GRL
         """
-        self += other
-        return self
+        return self.__combine(other, 'or')
 
     def __xor__(self, other):
         """ Exclusive OR (XOR) between two GRLs
         """
-        return (self | other) - (self & other)
+        return self.__combined(other, 'xor')
 
     def __ixor__(self, other):
         """ Update this GRL by removing overlap with another GRL
         """
-        grlcopy = copy.deepcopy(self)
-        self |= other
-        self -= (grlcopy & other)
-        return self
+        return self.__combine(other, 'xor')
+
+    def delta(self, other):
+        """
+        Return the GRLPatch that turns this GRL into another GRL,
+        i.e. the lumiblock ranges added and removed in each run
+
+        *other*: GRL
+        """
+        patch = GRLPatch(name=other.name, version=other.version)
+        for run in set(self.__grl) | set(other.__grl):
+            old = self.__grl.get(run, [])
+            new = other.__grl.get(run, [])
+            if old == new:
+                # most runs are unchanged between versions
+                continue
+            added, removed = delta_lbranges(old, new)
+            if added:
+                patch.added[run] = added
+            if removed:
+                patch.removed[run] = removed
+        return patch
+
+    def apply(self, patch):
+        """
+        Update this GRL in place with the lumiblock ranges added and removed
+        by a GRLPatch. The name and version of the GRL are set to those
+        recorded in the patch.
+
+        *patch*: GRLPatch
+        """
+        o = {}
+        for run in set(patch.added) | set(patch.removed):
+            lbranges = self.__grl.get(run, [])
+            if run in patch.removed:
+                # keep the ranges only in the current GRL
+                lbranges = delta_lbranges(patch.removed[run], lbranges)[0]
+            lbranges = merged_lbranges(
+                list(lbranges) + list(patch.added.get(run, ())))
+            if lbranges:
+                o[run] = lbranges
+            elif run in self.__grl:
+                del self.__grl[run]
+        self.__grl.update(o)
+        if patch.name is not None:
+            self.name = patch.name
+        if patch.version is not None:
+            self.version = patch.version
+        self.__merge_metadata()
 
     def cut(self, runname='RunNumber', lbname='lbn'):
         """
@@ -729,6 +1828,7 @@ class GRL(object):
 
         *format*: str
         """
+        import cStringIO
         str_io = cStringIO.StringIO()
         self.write(filehandle=str_io, format=format)
         return str_io.getvalue()
@@ -736,7 +1836,8 @@ class GRL(object):
     def save(self, name):
         """
         Save GRL to file by name. Determine format from
-        extension.
+        extension. The file is compressed if the extension is
+        followed by .gz, .bz2 or .xz, e.g. grl.xml.gz.
 
         *name*: str
         """
@@ -767,13 +1868,13 @@ class GRL(object):
             # return to previous directory
             cwd.cd()
         else:
-            _, ext = os.path.splitext(name)
+            _, ext = os.path.splitext(split_compression(name)[0])
             # ignore period
             ext = ext[1:]
             if ext not in GRL.formats:
                 raise ValueError(
                     "{0} does not have a valid GRL extension".format(name))
-            with open(name, 'w') as filehandle:
+            with open_compressed(name, 'w') as filehandle:
                 self.write(filehandle, format=ext)
 
     def write(self, filehandle, format='xml'):
@@ -796,8 +1897,6 @@ class GRL(object):
             name.text = self.name
             version = ET.SubElement(subroot, 'Version')
             version.text = self.version
-            for meta in self.metadata:
-                subroot.append(meta)
             for run in self.iterruns():
                 lumiblocks = self.__grl[run]
                 lbcol = ET.SubElement(subroot, 'LumiBlockCollection')
@@ -807,6 +1906,7 @@ class GRL(object):
                     lbrange = ET.SubElement(lbcol, 'LBRange')
                     lbrange.set('Start', str(lumiblock[0]))
                     lbrange.set('End', str(lumiblock[1]))
+            import datetime
             date = datetime.datetime.now().strftime("%Y-%m-%d at %H:%M:%S")
             meta = (
             '''<!DOCTYPE LumiRangeCollection SYSTEM '''
@@ -815,23 +1915,465 @@ class GRL(object):
             '''http://pypi.python.org/pypi/goodruns/ on {0} -->\n'''.format(date))
             filehandle.write('<?xml version="1.0"?>\n')
             filehandle.write(meta)
-            tree = ET.ElementTree(root)
             if info.USE_LXML:
-                tree.write(filehandle, pretty_print=True)
+                xml = ET.tostring(root, pretty_print=True)
             else:
-                xml = minidom.parseString(ET.tostring(tree.getroot(), 'utf-8'))
-                filehandle.write(pretty_xml(xml))
+                xml = pretty_xml(minidom.parseString(ET.tostring(root, 'utf-8')))
+            if self.metadata:
+                # insert the metadata verbatim after the name and version
+                index = xml.find('\n    <LumiBlockCollection>')
+                if index < 0:
+                    index = xml.find('\n  </NamedLumiRange>')
+                xml = ''.join([xml[:index]] +
+                              ['\n    ' + meta.raw for meta in self.metadata] +
+                              [xml[index:]])
+            filehandle.write(xml)
         elif format in ('yml', 'yaml'):
-            if not USE_YAML:
+            try:
+                import yaml
+            except ImportError:
                 raise RuntimeError(
                     "YAML is not installed (pip install pyyaml)")
-            filehandle.write(yaml.dump(self.to_dict()))
+            try:
+                from yaml import CSafeDumper as Dumper
+            except ImportError:
+                from yaml import SafeDumper as Dumper
+            filehandle.write(yaml.dump(
+                dict((run, [[lbrange[0], lbrange[1]] for lbrange in lbranges])
+                     for run, lbranges in self.__grl.iteritems()),
+                Dumper=Dumper, default_flow_style=None))
+        elif format == 'json':
+            import json
+            # keep runs in ascending order instead of sorting the keys
+            # as strings and use the C encoder for each run
+            filehandle.write('{')
+            filehandle.write(', '.join(
+                '"{0:d}": {1}'.format(run, json.dumps(
+                    [[lbrange[0], lbrange[1]] for lbrange in lbranges]))
+                for run, lbranges in self.__grl.iteritems()))
+            filehandle.write('}\n')
         elif format == 'txt':
-            filehandle.write(str(self) + '\n')
+            if not self.__grl:
+                filehandle.write('\n')
+            for line in self.iter_text_lines():
+                filehandle.write(line + '\n')
         elif format in ('py', 'python'):
+            from pprint import pprint
             filehandle.write("grl = ")
             pprint(self.__grl, stream=filehandle)
         elif format == 'cut':
             filehandle.write(self.cut() + '\n')
         else:
             raise ValueError("Unrecognized grl format")
+
+
+class GRLPatch(object):
+    """
+    The lumiblock ranges added and removed in each run between two versions
+    of a GRL, created by GRL.delta() and applied with GRL.apply().
+
+    A patch is written as text with one line per run and change::
+
+        name Tau_h
+        version 2.2
+        - 178044 5-10,12
+        + 178047 1-3
+
+    Lines starting with # are ignored and the ranges of several lines with
+    the same run and change are merged.
+    """
+    def __init__(self, name=None, version=None):
+        """
+        *name*: [ str | None ]
+            Name of the patched GRL
+
+        *version*: [ str | None ]
+            Version of the patched GRL
+        """
+        self.name = name
+        self.version = version
+        # run -> list of LumiblockRanges
+        self.added = {}
+        self.removed = {}
+
+    def __nonzero__(self):
+
+        return bool(self.added or self.removed)
+
+    def __eq__(self, other):
+
+        return (self.added == other.added and
+                self.removed == other.removed)
+
+    def __ne__(self, other):
+
+        return not self.__eq__(other)
+
+    @classmethod
+    def from_string(cls, string):
+        """
+        Create a GRLPatch from its text representation
+
+        *string*: str
+        """
+        patch = cls()
+        for number, line in enumerate(string.splitlines()):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition(' ')
+            value = value.strip()
+            if key == 'name':
+                patch.name = value
+            elif key == 'version':
+                patch.version = value
+            elif key in ('+', '-'):
+                try:
+                    run, lbranges = value.split()
+                    run = int(run)
+                    # several lines of the same run are merged,
+                    # e.g. in concatenated patches
+                    lbranges_dict = (patch.added if key == '+'
+                                     else patch.removed)
+                    pairs = list(lbranges_dict.get(run, []))
+                    for lbrange in lbranges.split(','):
+                        start, sep, end = lbrange.partition('-')
+                        pairs.append((int(start), int(end if sep else start)))
+                    lbranges = merged_lbranges(pairs)
+                except ValueError:
+                    raise ValueError(
+                        "invalid patch line {0:d}: {1}".format(
+                            number + 1, line))
+                lbranges_dict[run] = lbranges
+            else:
+                raise ValueError(
+                    "invalid patch line {0:d}: {1}".format(number + 1, line))
+        return patch
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a GRLPatch from a file
+
+        *filename*: str
+        """
+        with open(filename) as filehandle:
+            return cls.from_string(filehandle.read())
+
+    def str(self):
+        """
+        Return the text representation of the patch
+        """
+        import cStringIO
+        str_io = cStringIO.StringIO()
+        self.write(str_io)
+        return str_io.getvalue()
+
+    def save(self, filename):
+        """
+        Write the patch to a file
+
+        *filename*: str
+        """
+        with open(filename, 'w') as filehandle:
+            self.write(filehandle)
+
+    def write(self, filehandle):
+        """
+        Write the text representation of the patch to the file object
+
+        *filehandle*: file
+        """
+        if self.name is not None:
+            filehandle.write('name {0}\n'.format(self.name))
+        if self.version is not None:
+            filehandle.write('version {0}\n'.format(self.version))
+        for run in sorted(set(self.added) | set(self.removed)):
+            for key, lbranges_dict in (('-', self.removed),
+                                       ('+', self.added)):
+                if run in lbranges_dict:
+                    filehandle.write('{0} {1:d} {2}\n'.format(
+                        key, run, ','.join(
+                            str(lbrange[0]) if lbrange[0] == lbrange[1] else
+                            '{0:d}-{1:d}'.format(*lbrange)
+                            for lbrange in lbranges_dict[run])))
+
+
+LB_BITS = 32
+LB_MASK = (1 << LB_BITS) - 1
+
+
+def runlb_key(run, lbn):
+    """
+    Encode a run and lumiblock number as a single sortable integer key
+
+    *run*: int
+
+    *lbn*: int
+    """
+    if not 0 <= lbn <= LB_MASK:
+        raise ValueError(
+            "lumiblock number out of range: {0:d}".format(lbn))
+    return (run << LB_BITS) | lbn
+
+
+def key_runlb(key):
+    """
+    Decode an integer key created by runlb_key into a (run, lumiblock) tuple
+
+    *key*: int
+    """
+    return key >> LB_BITS, key & LB_MASK
+
+
+class LumiblockIndex(object):
+    """
+    A read-only index over all lumiblock ranges in a GRL where the boundaries
+    of each range are encoded as single sortable keys (run << 32 | lb).
+    Queries across run boundaries then require a single bisection.
+    The index is a snapshot and is not updated if the GRL is modified.
+    """
+    def __init__(self, grl):
+        """
+        *grl*: GRL
+        """
+        self.starts = []
+        self.ends = []
+        self.lbranges = []
+        for run, lbrange in grl.iterlbranges():
+            self.starts.append(runlb_key(run, lbrange[0]))
+            self.ends.append(runlb_key(run, lbrange[1]))
+            self.lbranges.append((run, lbrange))
+
+    def __len__(self):
+
+        return len(self.lbranges)
+
+    def __contains__(self, runlb):
+        """
+        Returns True if the index contains a run and lumiblock
+
+        *runlb*: tuple
+            2-tuple of ints containing run number and lumiblock number
+        """
+        return self.containing_range(*runlb) is not None
+
+    def containing_range(self, run, lbn):
+        """
+        Return the (run, lbrange) containing a run and lumiblock or None
+
+        *run*: int
+
+        *lbn*: int
+        """
+        key = runlb_key(run, lbn)
+        i = bisect.bisect_right(self.starts, key) - 1
+        if i >= 0 and self.ends[i] >= key:
+            return self.lbranges[i]
+        return None
+
+    def next_good(self, run, lbn):
+        """
+        Return the first good (run, lumiblock) at or after a run and
+        lumiblock or None if there are none
+
+        *run*: int
+
+        *lbn*: int
+        """
+        key = runlb_key(run, lbn)
+        i = bisect.bisect_left(self.ends, key)
+        if i == len(self.ends):
+            return None
+        return key_runlb(max(self.starts[i], key))
+
+    def prev_good(self, run, lbn):
+        """
+        Return the last good (run, lumiblock) at or before a run and
+        lumiblock or None if there are none
+
+        *run*: int
+
+        *lbn*: int
+        """
+        key = runlb_key(run, lbn)
+        i = bisect.bisect_right(self.starts, key) - 1
+        if i < 0:
+            return None
+        return key_runlb(min(self.ends[i], key))
+
+    def ranges_between(self, start, end):
+        """
+        Return the list of (run, lbrange) between two (run, lumiblock)
+        positions (inclusive). Ranges overlapping either position are clipped.
+
+        *start*: tuple
+            2-tuple of ints containing run number and lumiblock number
+
+        *end*: tuple
+            2-tuple of ints containing run number and lumiblock number
+        """
+        lo = runlb_key(*start)
+        hi = runlb_key(*end)
+        if lo > hi:
+            return []
+        first = bisect.bisect_left(self.ends, lo)
+        last = bisect.bisect_right(self.starts, hi, first)
+        lbranges = self.lbranges[first:last]
+        if lbranges:
+            if self.starts[first] < lo:
+                run, lbrange = lbranges[0]
+                lbranges[0] = (run, LumiblockRange(start[1], lbrange[1]))
+            if self.ends[last - 1] > hi:
+                run, lbrange = lbranges[-1]
+                lbranges[-1] = (run, LumiblockRange(lbrange[0], end[1]))
+        return lbranges
+
+
+# methods timed while statistics are enabled and the name of their phase
+INSTRUMENTED = [
+    (GRL, '__init__', 'parse'),
+    (GRL, '_GRL__optimize', 'normalize'),
+    (GRL, 'insert', 'insert'),
+    (GRL, 'remove', 'remove'),
+    (GRL, 'clip', 'clip'),
+    (SortedDict, '__deepcopy__', 'copy'),
+    (GRL, '__getstate__', 'copy'),
+    (GRL, '__setstate__', 'copy'),
+    (GRL, '__add__', 'add'),
+    (GRL, '__iadd__', 'iadd'),
+    (GRL, '__sub__', 'sub'),
+    (GRL, '__isub__', 'isub'),
+    (GRL, '__and__', 'and'),
+    (GRL, '__iand__', 'iand'),
+    (GRL, '__or__', 'or'),
+    (GRL, '__ior__', 'ior'),
+    (GRL, '__xor__', 'xor'),
+    (GRL, '__ixor__', 'ixor'),
+    (GRL, 'cut', 'cut'),
+    (GRL, 'write', 'write'),
+]
+
+# only the calls for which these functions return True are instrumented,
+# e.g. the empty GRLs created by the operators are not parsed
+INSTRUMENTED_IF = {
+    (GRL, '__init__'): lambda self, grl=None, *args, **kwargs: bool(grl),
+}
+
+# the statistics being collected or None if disabled
+_STATS = None
+# the original methods replaced while statistics are enabled
+_ORIGINALS = {}
+
+
+def _maxrss():
+
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Stats(object):
+    """
+    Counters and timers of the instrumented phases
+    """
+    def __init__(self):
+
+        import threading
+        self.phases = {}
+        self.lock = threading.Lock()
+        # per thread: time spent in nested phases of each active phase
+        self.local = threading.local()
+        self.start = time.time()
+        self.start_maxrss = _maxrss()
+
+    def wrap(self, phase, func, condition=None):
+
+        def wrapper(*args, **kwargs):
+            if condition is not None and not condition(*args, **kwargs):
+                return func(*args, **kwargs)
+            try:
+                nested_stack = self.local.nested
+            except AttributeError:
+                nested_stack = self.local.nested = []
+            nested_stack.append(0.)
+            maxrss = _maxrss()
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                nested = nested_stack.pop()
+                if nested_stack:
+                    nested_stack[-1] += elapsed
+                growth = _maxrss() - maxrss
+                with self.lock:
+                    try:
+                        stats = self.phases[phase]
+                    except KeyError:
+                        stats = self.phases[phase] = {
+                            'calls': 0,
+                            'time': 0.,
+                            'self_time': 0.,
+                            'maxrss_growth': 0,
+                        }
+                    stats['calls'] += 1
+                    stats['time'] += elapsed
+                    stats['self_time'] += elapsed - nested
+                    stats['maxrss_growth'] += growth
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+def enable_stats():
+    """
+    Start collecting counters and timers of the parse, normalize, insert,
+    remove, clip, copy, operator, cut and write phases. Any previously
+    collected statistics are discarded. The instrumented methods are only
+    replaced while statistics are enabled so there is no overhead otherwise.
+    """
+    global _STATS
+    disable_stats()
+    _STATS = _Stats()
+    for cls, name, phase in INSTRUMENTED:
+        func = cls.__dict__[name]
+        _ORIGINALS[(cls, name)] = func
+        setattr(cls, name, _STATS.wrap(phase, func,
+                                       INSTRUMENTED_IF.get((cls, name))))
+
+
+def disable_stats():
+    """
+    Stop collecting statistics and restore the original methods.
+    The statistics collected so far remain available from get_stats().
+    """
+    for (cls, name), func in _ORIGINALS.items():
+        setattr(cls, name, func)
+    _ORIGINALS.clear()
+
+
+def get_stats():
+    """
+    Return a dict of the statistics collected since enable_stats() was called
+    or None if statistics were never enabled.
+
+    For each phase, time is the total wall time in seconds spent in the
+    phase including nested phases, self_time excludes nested phases and
+    maxrss_growth is the total growth of the peak resident set size (as
+    reported by getrusage) while in the phase.
+    """
+    if _STATS is None:
+        return None
+    phases = {}
+    with _STATS.lock:
+        for phase, stats in _STATS.phases.items():
+            phases[phase] = dict(stats)
+    return {
+        'phases': phases,
+        'time': time.time() - _STATS.start,
+        'maxrss': _maxrss(),
+        'maxrss_growth': _maxrss() - _STATS.start_maxrss,
+    }
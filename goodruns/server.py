@@ -0,0 +1,347 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module provides a server that keeps GRLs in memory and answers queries
+over a Unix domain socket, and a client for it.
+
+Each request and response is a JSON object preceded by its length in bytes as
+a 4-byte unsigned big-endian integer. Requests contain an "op" and responses
+contain either a "result" or an "error".
+"""
+
+from .grl import GRL, LumiblockRange, ored, anded, xored, diffed
+
+import os
+import stat
+import errno
+import socket
+import struct
+import threading
+import json
+import SocketServer
+
+
+__all__ = [
+    'GRLServer',
+    'GRLClient',
+]
+
+
+HEADER = struct.Struct('!I')
+
+OPERATORS = {
+    'and': anded,
+    'or': ored,
+    'xor': xored,
+    'diff': diffed,
+}
+
+
+def _recv_exactly(sock, size):
+
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            if chunks:
+                raise IOError("connection closed in the middle of a message")
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def send_message(sock, message):
+    """
+    Send a length-prefixed JSON message
+
+    *sock*: socket
+
+    *message*: dict
+    """
+    data = json.dumps(message, separators=(',', ':'))
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_data(sock):
+
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        raise IOError("connection closed in the middle of a message")
+    return data
+
+
+def recv_message(sock):
+    """
+    Receive a length-prefixed JSON message or None if the connection
+    was closed
+
+    *sock*: socket
+    """
+    data = _recv_data(sock)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class _Source(object):
+    """
+    A GRL loaded from a source that is reloaded when the file changes
+    """
+    def __init__(self, source):
+
+        self.source = source
+        self.mtime = None
+        self.grl = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def get_mtime(self):
+
+        try:
+            return os.stat(self.source).st_mtime
+        except (OSError, TypeError):
+            # URLs and ROOT file paths are never reloaded
+            return None
+
+    def load(self):
+
+        # only remember the modification time once the file was parsed
+        # so that a partially written file is parsed again later
+        mtime = self.get_mtime()
+        grl = GRL(self.source)
+        self.grl, self.mtime = grl, mtime
+
+    def get(self):
+        """
+        Return the GRL after reloading it if the file has changed
+        """
+        if self.mtime is not None and self.get_mtime() != self.mtime:
+            with self.lock:
+                mtime = self.get_mtime()
+                if mtime is not None and mtime != self.mtime:
+                    # keep serving the previous GRL if the new file is
+                    # only partially written
+                    try:
+                        self.load()
+                    except Exception:
+                        pass
+        return self.grl
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+
+        while True:
+            try:
+                data = _recv_data(self.request)
+            except IOError:
+                # the client went away in the middle of a request
+                return
+            if data is None:
+                return
+            # malformed requests are answered with an error like failed ones
+            # and the connection stays usable
+            try:
+                request = json.loads(data)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+                response = {'result': self.server.answer(request)}
+            except Exception, e:
+                response = {'error': '{0}: {1}'.format(
+                    e.__class__.__name__, e)}
+            send_message(self.request, response)
+
+
+class GRLServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serve membership, run, range and set operation queries on named GRLs
+    over a Unix domain socket. GRL files are reloaded when they change.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, sources):
+        """
+        *path*: str
+            Path of the Unix domain socket
+
+        *sources*: dict
+            Mapping of names to anything accepted by GRL()
+
+        A stale socket at *path* is replaced. IOError is raised if *path*
+        exists and is not a socket.
+        """
+        self.sources = {}
+        for name, source in sources.items():
+            self.sources[name] = _Source(source)
+        self.socket_id = None
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise IOError(errno.EEXIST,
+                              "file exists and is not a socket", path)
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+
+    def server_bind(self):
+
+        SocketServer.UnixStreamServer.server_bind(self)
+        status = os.stat(self.server_address)
+        self.socket_id = (status.st_dev, status.st_ino)
+
+    def server_close(self):
+
+        SocketServer.UnixStreamServer.server_close(self)
+        # only remove the socket created by this server
+        try:
+            status = os.stat(self.server_address)
+        except OSError:
+            return
+        if (status.st_dev, status.st_ino) == self.socket_id:
+            os.unlink(self.server_address)
+
+    def get(self, name):
+
+        try:
+            return self.sources[name].get()
+        except KeyError:
+            raise KeyError("no GRL named {0}".format(name))
+
+    def answer(self, request):
+        """
+        Return the result of a request
+
+        *request*: dict
+        """
+        op = request['op']
+        if op == 'names':
+            return sorted(self.sources.keys())
+        if op in OPERATORS:
+            grl = OPERATORS[op](*[self.get(name) for name in request['grls']])
+            return [(run, lbrange[0], lbrange[1])
+                    for run, lbrange in grl.iterlbranges()]
+        grl = self.get(request['grl'])
+        if op == 'contains':
+            return grl.contains_many(request['runlbs'])
+        if op == 'has_run':
+            return [grl.has_run(run) for run in request['runs']]
+        if op == 'runs':
+            return grl.runs()
+        if op == 'ranges':
+            run = request['run']
+            if not grl.has_run(run):
+                return None
+            return grl[run]
+        raise ValueError("unknown operation: {0}".format(op))
+
+
+class GRLClient(object):
+    """
+    A client of a GRLServer for one named GRL
+    with the same query methods as a GRL
+    """
+    def __init__(self, path, name):
+        """
+        *path*: str
+            Path of the Unix domain socket
+
+        *name*: str
+            Name of the GRL on the server
+        """
+        self.path = path
+        self.name = name
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def close(self):
+
+        self.sock.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+
+        self.close()
+
+    def request(self, op, **kwargs):
+        """
+        Send a request and return the result
+
+        *op*: str
+
+        *kwargs*: dict
+            Arguments of the request
+        """
+        kwargs['op'] = op
+        send_message(self.sock, kwargs)
+        response = recv_message(self.sock)
+        if response is None:
+            raise IOError("connection closed by server")
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def __contains__(self, runlb):
+        """
+        Returns True if the GRL contains a run and lumiblock
+
+        *runlb*: tuple
+            2-tuple of ints containing run number and lumiblock number
+        """
+        return self.contains_many([runlb])[0]
+
+    def contains_many(self, runlbs):
+        """
+        Return a list of bools, one for each (run, lumiblock) in runlbs,
+        that are True if the GRL contains the run and lumiblock
+
+        *runlbs*: iterable
+        """
+        return self.request('contains', grl=self.name, runlbs=list(runlbs))
+
+    def has_run(self, run):
+        """
+        Returns True if run is in the GRL, else False
+
+        *run*: int
+        """
+        return self.request('has_run', grl=self.name, runs=[run])[0]
+
+    def runs(self):
+        """
+        Return list of runs in the GRL
+        """
+        return self.request('runs', grl=self.name)
+
+    def __getitem__(self, run):
+        """
+        Return list of lumiblock ranges for a run
+
+        *run*: int
+        """
+        lbranges = self.request('ranges', grl=self.name, run=run)
+        if lbranges is None:
+            raise KeyError(run)
+        return [LumiblockRange(*lbrange) for lbrange in lbranges]
+
+    def combine(self, op, *names):
+        """
+        Return the GRL resulting from a set operation between this GRL and
+        other GRLs on the server
+
+        *op*: str
+            One of and, or, xor or diff
+
+        *names*: tuple
+            Names of the other GRLs on the server
+        """
+        lbranges = {}
+        for run, start, end in self.request(
+                op, grls=[self.name] + list(names)):
+            lbranges.setdefault(run, []).append((start, end))
+        return GRL(lbranges)
@@ -0,0 +1,292 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module shares a read-only copy of a GRL between processes, e.g. the
+workers of a multiprocessing.Pool. The runs and lumiblock ranges are written
+once as flat arrays of 64-bit integers in a file in /dev/shm (or the
+temporary directory) that every process maps into memory. Pickling a
+SharedGRL only sends the name of the file.
+
+    with grl.to_shared() as shared:
+        pool.map(process, [(shared, filename) for filename in filenames])
+"""
+
+from .grl import GRL, LumiblockRange
+
+import os
+import mmap
+import bisect
+import struct
+import random
+import tempfile
+
+
+__all__ = [
+    'SharedGRL',
+    'attach',
+]
+
+
+MAGIC = 'GRLSHM1\0'
+# magic, token, number of runs, number of lumiblock ranges
+HEADER = struct.Struct('<8sQQQ')
+INT64 = struct.Struct('<q')
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# (path, token) -> SharedGRL attached in this process
+_ATTACHED = {}
+
+
+class _Int64Array(object):
+    """
+    A read-only sequence of 64-bit integers in a buffer
+    that can be searched with the bisect module
+    """
+    def __init__(self, buf, offset, length):
+
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+
+        return self.length
+
+    def __getitem__(self, index):
+
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return INT64.unpack_from(self.buf, self.offset + 8 * index)[0]
+
+
+def _pack(filehandle, values):
+
+    values = list(values)
+    filehandle.write(struct.pack('<{0:d}q'.format(len(values)), *values))
+
+
+def attach(path, token=None):
+    """
+    Return the SharedGRL in a file, reusing the mapping
+    if it is already attached in this process
+
+    *path*: str
+
+    *token*: [ int | None ]
+        If not None, the token the SharedGRL was created with
+    """
+    shared = _ATTACHED.get((path, token))
+    if shared is None or shared.closed:
+        shared = SharedGRL(path)
+        if token is not None and shared.token != token:
+            shared.close()
+            raise ValueError(
+                "{0} does not contain the expected GRL".format(path))
+        _ATTACHED[(path, token)] = shared
+    return shared
+
+
+class SharedGRL(object):
+    """
+    A read-only GRL stored in a memory-mapped file. Use GRL.to_shared() or
+    SharedGRL.create() to create it and close() and unlink() (or a with
+    statement) to release it. Other processes attach to the same memory when
+    a SharedGRL is unpickled.
+    """
+    def __init__(self, path):
+        """
+        Attach to the SharedGRL in a file
+
+        *path*: str
+        """
+        self.path = path
+        self.owner = False
+        with open(path, 'rb') as filehandle:
+            self.buf = mmap.mmap(filehandle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        magic, self.token, nruns, nranges = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            self.buf.close()
+            raise ValueError("{0} does not contain a SharedGRL".format(path))
+        offset = HEADER.size
+        self.run_numbers = _Int64Array(self.buf, offset, nruns)
+        offset += 8 * nruns
+        # lumiblock ranges of run i are offsets[i] to offsets[i + 1]
+        self.offsets = _Int64Array(self.buf, offset, nruns + 1)
+        offset += 8 * (nruns + 1)
+        self.starts = _Int64Array(self.buf, offset, nranges)
+        offset += 8 * nranges
+        self.ends = _Int64Array(self.buf, offset, nranges)
+
+    @classmethod
+    def create(cls, grl, dir=None):
+        """
+        Write a GRL into a new shared file and return the SharedGRL owning it
+
+        *grl*: GRL
+
+        *dir*: [ str | None ]
+            Directory of the file (default: /dev/shm if it exists, otherwise
+            the temporary directory)
+        """
+        if dir is None:
+            dir = SHM_DIR
+        runs = grl.runs()
+        offsets = [0]
+        for run in runs:
+            offsets.append(offsets[-1] + len(grl[run]))
+        token = random.getrandbits(64)
+        fd, path = tempfile.mkstemp(prefix='goodruns-', suffix='.grl',
+                                    dir=dir)
+        try:
+            with os.fdopen(fd, 'wb') as filehandle:
+                filehandle.write(HEADER.pack(MAGIC, token,
+                                             len(runs), offsets[-1]))
+                _pack(filehandle, runs)
+                _pack(filehandle, offsets)
+                _pack(filehandle, (lbrange[0]
+                                   for run, lbrange in grl.iterlbranges()))
+                _pack(filehandle, (lbrange[1]
+                                   for run, lbrange in grl.iterlbranges()))
+            shared = cls(path)
+        except:
+            os.unlink(path)
+            raise
+        shared.owner = True
+        return shared
+
+    def __reduce__(self):
+
+        # only send the name of the file
+        return attach, (self.path, self.token)
+
+    @property
+    def closed(self):
+
+        return self.buf is None
+
+    def close(self):
+        """
+        Unmap the shared memory in this process
+        """
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        if _ATTACHED.get((self.path, self.token)) is self:
+            del _ATTACHED[(self.path, self.token)]
+
+    def unlink(self):
+        """
+        Remove the shared file if this SharedGRL created it. Processes that
+        are already attached keep their mapping until they close it.
+        """
+        if self.owner and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+
+        self.close()
+        self.unlink()
+
+    def __len__(self):
+
+        return len(self.run_numbers)
+
+    def __nonzero__(self):
+
+        return len(self.run_numbers) > 0
+
+    def __index(self, run):
+
+        i = bisect.bisect_left(self.run_numbers, run)
+        if i == len(self.run_numbers) or self.run_numbers[i] != run:
+            return None
+        return i
+
+    def __contains__(self, runlb):
+        """
+        Returns True if this GRL contains a run and lumiblock
+
+        *runlb*: tuple
+            2-tuple of ints containing run number and lumiblock number
+        """
+        return self.contains_many([runlb])[0]
+
+    def contains_many(self, runlbs):
+        """
+        Return a list of bools, one for each (run, lumiblock) in runlbs,
+        that are True if this GRL contains the run and lumiblock
+
+        *runlbs*: iterable
+        """
+        # (first, last) lumiblock range of each run queried so far
+        bounds = {}
+        result = []
+        for run, lbn in runlbs:
+            try:
+                first, last = bounds[run]
+            except KeyError:
+                i = self.__index(run)
+                if i is None:
+                    first = last = 0
+                else:
+                    first, last = self.offsets[i], self.offsets[i + 1]
+                bounds[run] = first, last
+            j = bisect.bisect_left(self.ends, lbn, first, last)
+            result.append(j != last and self.starts[j] <= lbn)
+        return result
+
+    def has_run(self, run):
+        """
+        Returns True if run is in GRL, else False
+
+        *run*: int
+        """
+        return self.__index(run) is not None
+
+    def __iter__(self):
+        """
+        Iterate over runs in GRL
+        """
+        for i in xrange(len(self.run_numbers)):
+            yield self.run_numbers[i]
+
+    def runs(self):
+        """
+        Return list of runs in GRL
+        """
+        return list(self)
+
+    def __getitem__(self, run):
+        """
+        Return list of lumiblock ranges for a run
+
+        *run*: int
+        """
+        i = self.__index(run)
+        if i is None:
+            raise KeyError(run)
+        return [LumiblockRange(self.starts[j], self.ends[j])
+                for j in xrange(self.offsets[i], self.offsets[i + 1])]
+
+    def iterlbranges(self):
+        """
+        Iterate over (run, lbrange) in GRL
+        """
+        for i, run in enumerate(self):
+            for j in xrange(self.offsets[i], self.offsets[i + 1]):
+                yield run, LumiblockRange(self.starts[j], self.ends[j])
+
+    def to_grl(self):
+        """
+        Return a copy of this GRL as a GRL
+        """
+        lbranges = {}
+        for run, lbrange in self.iterlbranges():
+            lbranges.setdefault(run, []).append(lbrange)
+        return GRL(lbranges)
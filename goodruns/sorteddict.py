@@ -51,7 +51,14 @@ class SortedDict(dict):
 
     def __delitem__(self, key):
         super(SortedDict, self).__delitem__(key)
-        self.key_order.remove(key)
+        self._remove_key(key)
+
+    def _remove_key(self, key):
+        # key_order is sorted so there is no need for a linear search
+        index = bisect.bisect_left(self.key_order, key)
+        if index == len(self.key_order) or self.key_order[index] != key:
+            raise ValueError("{0!r} is not in key_order".format(key))
+        del self.key_order[index]
 
     def __iter__(self):
         return iter(self.key_order)
@@ -59,7 +66,7 @@ class SortedDict(dict):
     def pop(self, k, *args):
         result = super(SortedDict, self).pop(k, *args)
         try:
-            self.key_order.remove(k)
+            self._remove_key(k)
         except ValueError:
             # Key wasn't in the dictionary in the first place. No problem.
             pass
@@ -67,7 +74,7 @@ class SortedDict(dict):
 
     def popitem(self):
         result = super(SortedDict, self).popitem()
-        self.key_order.remove(result[0])
+        self._remove_key(result[0])
         return result
 
     def items(self):
@@ -91,12 +98,16 @@ class SortedDict(dict):
             yield self[key]
 
     def update(self, dict_):
-        for k, v in dict_.iteritems():
-            self[k] = v
+        new_keys = [k for k in dict_ if k not in self]
+        super(SortedDict, self).update(dict_)
+        if new_keys:
+            # sorting once is much faster than one insert per new key
+            self.key_order.extend(new_keys)
+            self.key_order.sort()
 
     def setdefault(self, key, default):
         if key not in self:
-            self.key_order.append(key)
+            self.key_order.insert(bisect.bisect(self.key_order, key), key)
         return super(SortedDict, self).setdefault(key, default)
 
     def copy(self):
@@ -0,0 +1,221 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module stores many versions of GRLs in a content-addressed directory.
+The lumiblock ranges of each run are stored once as a chunk named by the
+SHA-1 of its content and each GRL is a small manifest of run numbers and
+chunk names, so runs that are identical in several versions are only stored
+and decoded once::
+
+    store/
+        chunks/ab/abcdef...   lumiblock ranges of a run
+        manifests/01/0123...  name, version, metadata, runs and chunks of a GRL
+        labels/LABEL          manifest of the GRL with this label
+"""
+
+from .grl import GRL, LumiblockRange, Metadata, _pack_ints, _unpack_ints
+
+import os
+import json
+import hashlib
+import tempfile
+from itertools import izip
+
+
+__all__ = [
+    'Store',
+]
+
+
+def _umask():
+    """
+    Return the umask of this process
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _str(value):
+    """
+    Return a string decoded from JSON as str if it is ASCII like the strings
+    of a parsed GRL
+    """
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return value
+
+
+def _write_atomic(filename, data):
+    """
+    Write a file so that readers never see it partially written
+    """
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as filehandle:
+            filehandle.write(data)
+        # mkstemp creates files only readable by their owner
+        os.chmod(tmp, 0666 & ~_umask())
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class Store(object):
+    """
+    A content-addressed store of GRLs where each distinct list of lumiblock
+    ranges is stored once and shared by all GRLs containing it
+    """
+    def __init__(self, path):
+        """
+        *path*: str
+            Directory of the store. It is created if it does not exist.
+        """
+        self.path = path
+        for subdir in ('chunks', 'manifests', 'labels'):
+            subdir = os.path.join(path, subdir)
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+        # chunk name -> decoded lumiblock ranges
+        self.cache = {}
+
+    def __object_path(self, kind, digest):
+
+        return os.path.join(self.path, kind, digest[:2], digest)
+
+    def __label_path(self, label):
+
+        if not label or label.startswith('.') or os.sep in label:
+            raise ValueError("invalid label: {0!r}".format(label))
+        return os.path.join(self.path, 'labels', label)
+
+    def __put_object(self, kind, data):
+
+        digest = hashlib.sha1(data).hexdigest()
+        filename = self.__object_path(kind, digest)
+        if not os.path.exists(filename):
+            _write_atomic(filename, data)
+        return digest
+
+    def __get_object(self, kind, digest):
+
+        with open(self.__object_path(kind, digest), 'rb') as filehandle:
+            return filehandle.read()
+
+    def put(self, grl, label=None, force=False):
+        """
+        Store a GRL and return the name of its manifest. Only the runs whose
+        lumiblock ranges are not already in the store are written. The name,
+        version and raw XML of the Metadata elements are stored in the
+        manifest.
+
+        *grl*: GRL
+
+        *label*: [ str | None ]
+            If not None, also refer to the GRL by this label. A previous GRL
+            with the same label remains in the store.
+
+        *force*: bool
+            Move a label that refers to another GRL instead of raising
+            ValueError
+        """
+        runs = []
+        for run, lbranges in grl.items():
+            data = _pack_ints(bound for lbrange in lbranges
+                              for bound in lbrange)
+            runs.append([run, self.__put_object('chunks', data)])
+        manifest = {'name': grl.name,
+                    'version': grl.version,
+                    'runs': runs}
+        if grl.metadata:
+            manifest['metadata'] = [[meta.name, meta.raw]
+                                    for meta in grl.metadata]
+        manifest = json.dumps(manifest, sort_keys=True)
+        label_path = None
+        if label is not None:
+            label_path = self.__label_path(label)
+            if not force and os.path.exists(label_path):
+                with open(label_path) as filehandle:
+                    previous = filehandle.read().strip()
+                if previous != hashlib.sha1(manifest).hexdigest():
+                    raise ValueError(
+                        "label {0} already refers to {1}".format(
+                            label, previous))
+        digest = self.__put_object('manifests', manifest)
+        if label_path is not None:
+            _write_atomic(label_path, digest + '\n')
+        return digest
+
+    def resolve(self, ref):
+        """
+        Return the name of the manifest of a label or of a manifest name
+
+        *ref*: str
+            Label or manifest name
+        """
+        try:
+            with open(self.__label_path(ref)) as filehandle:
+                return filehandle.read().strip()
+        except (IOError, ValueError):
+            pass
+        if os.path.exists(self.__object_path('manifests', ref)):
+            return ref
+        raise KeyError("no GRL labelled or named {0}".format(ref))
+
+    def get(self, ref):
+        """
+        Return the GRL with a label or manifest name assembled from its
+        chunks. Chunks already decoded by this Store are reused.
+
+        *ref*: str
+            Label or manifest name
+        """
+        manifest = json.loads(self.__get_object('manifests', self.resolve(ref)))
+        lbranges = {}
+        for run, digest in manifest['runs']:
+            chunk = self.cache.get(digest)
+            if chunk is None:
+                bounds = iter(_unpack_ints(self.__get_object('chunks', digest)))
+                # the lumiblock ranges were valid and merged when stored
+                chunk = self.cache[digest] = [
+                    tuple.__new__(LumiblockRange, lbrange)
+                    for lbrange in izip(bounds, bounds)]
+            lbranges[run] = list(chunk)
+        grl = GRL.from_normalized(lbranges)
+        grl.name = _str(manifest['name'])
+        grl.version = _str(manifest['version'])
+        # the raw XML was encoded as UTF-8 when it was stored
+        grl.metadata = [Metadata(_str(name), raw.encode('utf-8'))
+                        for name, raw in manifest.get('metadata', ())]
+        return grl
+
+    def labels(self):
+        """
+        Return the sorted list of (label, manifest name)
+        """
+        labels = []
+        for label in sorted(os.listdir(os.path.join(self.path, 'labels'))):
+            if label.startswith('.'):
+                continue
+            labels.append((label, self.resolve(label)))
+        return labels
+
+    def __contains__(self, ref):
+
+        try:
+            self.resolve(ref)
+        except KeyError:
+            return False
+        return True
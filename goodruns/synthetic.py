@@ -0,0 +1,174 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module generates reproducible synthetic GRLs for scale and stress testing
+"""
+
+from .grl import GRL
+
+import math
+import random
+
+
+__all__ = [
+    'generate',
+    'generate_pair',
+]
+
+
+FIRST_RUN = 100000
+
+
+def _as_interval(value):
+
+    if isinstance(value, (int, long)):
+        return value, value
+    low, high = value
+    if low > high:
+        raise ValueError("interval in wrong order: {0}".format((value,)))
+    return low, high
+
+
+def _run_numbers(nruns, rng, first_run, run_step):
+
+    low, high = _as_interval(run_step)
+    if low < 1:
+        raise ValueError("run_step must be at least 1")
+    runs = []
+    run = first_run
+    for i in xrange(nruns):
+        runs.append(run)
+        run += rng.randint(low, high)
+    return runs
+
+
+def _fragment(start, end, rng, fragmentation, lbranges):
+    """
+    Append the parts of [start, end] left after punching single-lumiblock
+    holes with probability fragmentation per lumiblock
+    """
+    if not fragmentation:
+        lbranges.append((start, end))
+        return
+    log_keep = math.log(1. - fragmentation)
+    while start <= end:
+        # distance to the next hole is geometrically distributed
+        hole = start + int(math.log(1. - rng.random()) / log_keep)
+        if hole > end:
+            lbranges.append((start, end))
+            return
+        if hole > start:
+            lbranges.append((start, hole - 1))
+        start = hole + 1
+
+
+def _generate(runs, rng, ranges_per_run, range_length,
+              gap_length, fragmentation, name):
+
+    if not 0 <= fragmentation < 1:
+        raise ValueError("fragmentation must be in the interval [0, 1)")
+    nranges_low, nranges_high = _as_interval(ranges_per_run)
+    length_low, length_high = _as_interval(range_length)
+    gap_low, gap_high = _as_interval(gap_length)
+    if nranges_low < 1 or length_low < 1 or gap_low < 1:
+        raise ValueError("ranges_per_run, range_length and gap_length "
+                         "must be at least 1")
+    d = {}
+    for run in runs:
+        lbranges = []
+        lb = rng.randint(gap_low, gap_high)
+        for i in xrange(rng.randint(nranges_low, nranges_high)):
+            end = lb + rng.randint(length_low, length_high) - 1
+            _fragment(lb, end, rng, fragmentation, lbranges)
+            lb = end + 1 + rng.randint(gap_low, gap_high)
+        if lbranges:
+            d[run] = lbranges
+    grl = GRL(d)
+    if name is not None:
+        grl.name = name
+    return grl
+
+
+def generate(nruns, seed=None, first_run=FIRST_RUN, run_step=(1, 10),
+             ranges_per_run=(1, 20), range_length=(1, 100),
+             gap_length=(1, 20), fragmentation=0., name=None):
+    """
+    Generate a synthetic GRL with random lumiblock ranges.
+
+    Intervals are either a single int or a 2-tuple of the inclusive lower and
+    upper bounds of a uniformly distributed random integer.
+
+    *nruns*: int
+        Number of runs
+
+    *seed*: [ int | None ]
+        Seed of the random number generator. The same seed and arguments
+        always produce the same GRL.
+
+    *first_run*: int
+
+    *run_step*: [ int | tuple ]
+        Interval of the difference between consecutive run numbers
+
+    *ranges_per_run*: [ int | tuple ]
+        Interval of the number of lumiblock ranges in each run before
+        fragmentation
+
+    *range_length*: [ int | tuple ]
+        Interval of the number of lumiblocks in each range before
+        fragmentation
+
+    *gap_length*: [ int | tuple ]
+        Interval of the number of lumiblocks between consecutive ranges
+
+    *fragmentation*: float
+        Probability in [0, 1) that a lumiblock inside a range is removed,
+        splitting the range in two
+
+    *name*: [ str | None ]
+    """
+    rng = random.Random(seed)
+    runs = _run_numbers(nruns, random.Random(rng.getrandbits(64)),
+                        first_run, run_step)
+    return _generate(runs, random.Random(rng.getrandbits(64)),
+                     ranges_per_run, range_length, gap_length,
+                     fragmentation, name)
+
+
+def generate_pair(nruns, overlap=0.5, seed=None, first_run=FIRST_RUN,
+                  run_step=(1, 10), **kwargs):
+    """
+    Generate a pair of synthetic GRLs with nruns runs each where a fraction of
+    the runs is common to both. The lumiblock ranges in common runs are
+    generated independently and only partially overlap.
+
+    *nruns*: int
+        Number of runs in each GRL
+
+    *overlap*: float
+        Fraction of runs in [0, 1] common to both GRLs
+
+    *seed*: [ int | None ]
+
+    *first_run*: int
+
+    *run_step*: [ int | tuple ]
+
+    *kwargs*: dict
+        Remaining arguments are passed to generate()
+    """
+    if not 0 <= overlap <= 1:
+        raise ValueError("overlap must be in the interval [0, 1]")
+    rng = random.Random(seed)
+    offset = nruns - int(round(overlap * nruns))
+    runs = _run_numbers(nruns + offset, random.Random(rng.getrandbits(64)),
+                        first_run, run_step)
+    name = kwargs.pop('name', None)
+    options = dict(ranges_per_run=(1, 20), range_length=(1, 100),
+                   gap_length=(1, 20), fragmentation=0.)
+    options.update(kwargs)
+    first = _generate(runs[:nruns], random.Random(rng.getrandbits(64)),
+                      name=name, **options)
+    second = _generate(runs[offset:], random.Random(rng.getrandbits(64)),
+                       name=name, **options)
+    return first, second
@@ -4,14 +4,34 @@ import nose
 from nose.tools import assert_raises, assert_equal, assert_true
 from nose.exc import SkipTest
 import os
-from goodruns import GRL, LumiblockRange
+import copy
+from goodruns import GRL, GRLPatch, LumiblockRange, LumiblockIndex
 from goodruns import info
+from goodruns import synthetic
 info.USE_YAML = True
 info.USE_LXML = True
 
 DIRNAME = os.path.dirname(__file__)
 GRLA = os.path.join(DIRNAME, 'grlA.xml')
 GRLB = os.path.join(DIRNAME, 'grlB.xml')
+SCRIPT = os.path.join(DIRNAME, os.pardir, os.pardir, 'scripts', 'grl')
+
+
+def run_script(args, stdin=None, returncode=0):
+    """
+    Run the grl script with the goodruns package of this tree, check its
+    exit status and return its output
+    """
+    import sys
+    import subprocess
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(DIRNAME, os.pardir, os.pardir)
+    process = subprocess.Popen([sys.executable, SCRIPT] + args, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate(stdin or '')
+    assert_equal(process.returncode, returncode, stderr)
+    return stdout
 
 
 def grl_logic_test():
@@ -104,6 +124,432 @@ def from_string_test():
     assert_equal(grlb, grl)
 
 
+def index_test():
+
+    grl = GRL({1: [(5, 10), (20, 30)], 3: [(1, 4)]})
+    index = LumiblockIndex(grl)
+    assert_equal(len(index), 3)
+    assert_true((1, 7) in index)
+    assert_true((1, 11) not in index)
+    assert_equal(index.containing_range(1, 25), (1, (20, 30)))
+    assert_equal(index.containing_range(2, 1), None)
+    assert_equal(index.next_good(1, 1), (1, 5))
+    assert_equal(index.next_good(1, 7), (1, 7))
+    assert_equal(index.next_good(1, 11), (1, 20))
+    assert_equal(index.next_good(1, 31), (3, 1))
+    assert_equal(index.next_good(3, 5), None)
+    assert_equal(index.prev_good(3, 0), (1, 30))
+    assert_equal(index.prev_good(1, 15), (1, 10))
+    assert_equal(index.prev_good(1, 4), None)
+    assert_equal(index.ranges_between((1, 8), (3, 2)),
+                 [(1, (8, 10)), (1, (20, 30)), (3, (1, 2))])
+    assert_equal(index.ranges_between((1, 22), (1, 25)), [(1, (22, 25))])
+    assert_equal(index.ranges_between((1, 11), (1, 19)), [])
+    assert_equal(index.ranges_between((3, 0), (1, 0)), [])
+
+    grl = GRL(GRLA)
+    index = LumiblockIndex(grl)
+    for run, lbrange in grl.iterlbranges():
+        assert_equal(index.containing_range(run, lbrange[1]), (run, lbrange))
+
+
+def synthetic_test():
+
+    a = synthetic.generate(100, seed=1, fragmentation=0.1)
+    assert_equal(len(a.runs()), 100)
+    assert_equal(a, synthetic.generate(100, seed=1, fragmentation=0.1))
+    assert_true(a != synthetic.generate(100, seed=2, fragmentation=0.1))
+    for run in a:
+        lbranges = a[run]
+        for left, right in zip(lbranges[:-1], lbranges[1:]):
+            # sorted and not adjacent
+            assert_true(left[1] + 1 < right[0])
+    # generated GRLs are already optimized
+    assert_equal(a, a | a)
+
+    a, b = synthetic.generate_pair(100, overlap=0.25, seed=1)
+    assert_equal(len(a.runs()), 100)
+    assert_equal(len(b.runs()), 100)
+    assert_equal(len(set(a.runs()) & set(b.runs())), 25)
+    a, b = synthetic.generate_pair(10, overlap=0, seed=1)
+    assert_true(not (a & b))
+    assert_raises(ValueError, synthetic.generate, 10, fragmentation=1)
+    assert_raises(ValueError, synthetic.generate_pair, 10, overlap=2)
+
+
+def stats_test():
+
+    import goodruns
+    a = GRL(GRLA)
+    b = GRL(GRLB)
+    insert = GRL.__dict__['insert']
+    goodruns.enable_stats()
+    try:
+        GRL(GRLA)
+        a & b
+        a - b
+        a.str()
+    finally:
+        goodruns.disable_stats()
+    stats = goodruns.get_stats()
+    phases = stats['phases']
+    # the empty GRLs created by the operators are not parsed
+    assert_equal(phases['parse']['calls'], 1)
+    assert_equal(phases['and']['calls'], 1)
+    assert_equal(phases['sub']['calls'], 1)
+    assert_equal(phases['write']['calls'], 1)
+    assert_true(phases['and']['self_time'] <= phases['and']['time'])
+    # instrumentation is removed when disabled
+    a | b
+    assert_true('or' not in goodruns.get_stats()['phases'])
+    assert_true(GRL.__dict__['insert'] is insert)
+
+
+def stats_threads_test():
+
+    import goodruns
+    from goodruns import load_many
+    goodruns.enable_stats()
+    try:
+        load_many([GRLA, GRLB] * 8, limit=8)
+    finally:
+        goodruns.disable_stats()
+    phases = goodruns.get_stats()['phases']
+    assert_equal(phases['parse']['calls'], 16)
+    for stats in phases.values():
+        assert_true(0 <= stats['self_time'] <= stats['time'])
+
+
+def contains_many_test():
+
+    grl = GRL(GRLA)
+    runlbs = [(180225, 87), (180225, 1), (1, 1), (180225, 87)]
+    assert_equal(grl.contains_many(runlbs), [runlb in grl for runlb in runlbs])
+    for run, lbrange in grl.iterlbranges():
+        runlbs = [(run, lbrange[0] - 1), (run, lbrange[0]),
+                  (run, lbrange[1]), (run, lbrange[1] + 1)]
+        assert_equal(grl.contains_many(runlbs),
+                     [runlb in grl for runlb in runlbs])
+
+
+def server_test():
+
+    import tempfile
+    import shutil
+    import socket
+    import threading
+    import time
+    from goodruns.server import GRLServer, GRLClient
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'grl.sock')
+        filename = os.path.join(tmpdir, 'a.xml')
+        GRL(GRLA).save(filename)
+        server = GRLServer(path, {'a': filename, 'b': GRLB})
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            a = GRL(GRLA)
+            b = GRL(GRLB)
+            with GRLClient(path, 'a') as client:
+                assert_true((180225, 87) in client)
+                assert_true((180225, 1) not in client)
+                runlbs = [(180225, 87), (180225, 1), (1, 1)]
+                assert_equal(client.contains_many(runlbs),
+                             a.contains_many(runlbs))
+                assert_true(client.has_run(180225))
+                assert_equal(client.runs(), a.runs())
+                assert_equal(client[180225], a[180225])
+                assert_raises(KeyError, client.__getitem__, 1)
+                assert_equal(client.combine('and', 'b'), a & b)
+                assert_equal(client.combine('diff', 'b'), a - b)
+                assert_raises(RuntimeError, client.combine, 'and', 'c')
+                # malformed requests are answered with an error
+                from goodruns.server import HEADER, recv_message
+                for data in ('{"op": "runs", "gr', '[]', '{"grl": "a"}'):
+                    client.sock.sendall(HEADER.pack(len(data)) + data)
+                    assert_true('error' in recv_message(client.sock))
+                assert_equal(client.runs(), a.runs())
+                # modified files are reloaded
+                time.sleep(0.01)
+                GRL({1: [(1, 10)]}).save(filename)
+                os.utime(filename, (time.time() + 10, time.time() + 10))
+                assert_true((1, 5) in client)
+                assert_true((180225, 87) not in client)
+                # a partially written file is parsed again once complete
+                # even if its modification time did not change
+                with open(filename, 'w') as partial:
+                    partial.write('<LumiRangeCollection>')
+                os.utime(filename, (time.time() + 20, time.time() + 20))
+                mtime = os.stat(filename).st_mtime
+                assert_true((1, 5) in client)
+                GRL({2: [(1, 10)]}).save(filename)
+                os.utime(filename, (mtime, mtime))
+                assert_true((2, 5) in client)
+                assert_true((1, 5) not in client)
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert_true(not os.path.exists(path))
+        # files that are not sockets are never removed
+        assert_raises(IOError, GRLServer, filename, {'b': GRLB})
+        assert_equal(GRL(filename), GRL({2: [(1, 10)]}))
+        # a stale socket is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = GRLServer(path, {'b': GRLB})
+        # the server does not remove a file that replaced its socket
+        os.unlink(path)
+        os.rename(filename, path)
+        server.server_close()
+        assert_true(os.path.exists(path))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def load_many_test():
+
+    from goodruns import load_many
+    sources = [GRLA, GRLB, GRLA]
+    grls = load_many(sources, limit=2)
+    assert_equal(grls, [GRL(source) for source in sources])
+    assert_equal(load_many([]), [])
+    invalid = os.path.join(DIRNAME, 'grlA.badext')
+    grls = load_many([GRLA, invalid, GRLB], return_exceptions=True)
+    assert_equal(grls[0], GRL(GRLA))
+    assert_true(isinstance(grls[1], ValueError))
+    assert_equal(grls[2], GRL(GRLB))
+    assert_raises(ValueError, load_many, [GRLA, invalid])
+    assert_raises(ValueError, load_many, [GRLA], limit=0)
+
+
+def catalog_test():
+
+    import tempfile
+    import shutil
+    import time
+    from goodruns.catalog import Catalog
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename_a = os.path.join(tmpdir, 'a.xml')
+        filename_b = os.path.join(tmpdir, 'b.xml')
+        a = GRL(GRLA)
+        a.save(filename_a)
+        GRL(GRLB).save(filename_b)
+        with Catalog(os.path.join(tmpdir, 'catalog.db')) as catalog:
+            assert_equal(catalog.update([filename_a, filename_b]),
+                         [filename_a, filename_b])
+            # unchanged files are not parsed again
+            assert_equal(catalog.update([filename_a, filename_b]), [])
+            assert_equal(catalog.find(180225, 87), [filename_a, filename_b])
+            assert_equal(catalog.find(180225, 1), [])
+            assert_equal(catalog.find(180225), [filename_a, filename_b])
+            assert_equal(catalog.find(1), [])
+            for run, lbrange in a.iterlbranges():
+                assert_true(filename_a in catalog.find(run, lbrange[0]))
+                assert_true(filename_a in catalog.find(run, lbrange[1]))
+            # the same content with a new modification time
+            os.utime(filename_a, (time.time() + 10, time.time() + 10))
+            assert_equal(catalog.update([filename_a]), [])
+            GRL({1: [(1, 10)]}).save(filename_a)
+            os.utime(filename_a, (time.time() + 20, time.time() + 20))
+            assert_equal(catalog.update([filename_a]), [filename_a])
+            assert_equal(catalog.find(1, 5), [filename_a])
+            assert_equal(catalog.find(180225, 87), [filename_b])
+            os.unlink(filename_b)
+            assert_equal(catalog.prune(), [filename_b])
+            assert_equal(catalog.sources(), [filename_a])
+            assert_equal(catalog.find(180225), [])
+            # sources before a bad GRL remain indexed
+            bad = os.path.join(tmpdir, 'bad.xml')
+            with open(bad, 'w') as bad_file:
+                bad_file.write('not a GRL')
+            GRL(GRLB).save(filename_b)
+            try:
+                catalog.update([filename_b, bad])
+            except ValueError, e:
+                assert_true(bad in str(e))
+            else:
+                assert_true(False, "bad GRL was indexed")
+            assert_equal(catalog.sources(), [filename_a, filename_b])
+        # grl index indexes the other GRLs and fails
+        catalog = os.path.join(tmpdir, 'script.db')
+        run_script(['index', '-c', catalog, bad, filename_b], returncode=1)
+        output = run_script(['find', '-c', catalog, '--run', '180225'])
+        assert_equal(output, filename_b + '\n')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def catalog_relative_source_test():
+
+    import tempfile
+    import shutil
+    from goodruns.catalog import Catalog
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'a.xml')
+        GRL(GRLA).save(filename)
+        os.chdir(tmpdir)
+        with Catalog('catalog.db') as catalog:
+            assert_equal(catalog.update(['a.xml']), [filename])
+            # the same file by its absolute name is not indexed again
+            assert_equal(catalog.update([filename]), [])
+            assert_equal(catalog.sources(), [filename])
+        os.chdir(cwd)
+        with Catalog(os.path.join(tmpdir, 'catalog.db')) as catalog:
+            # pruning from another directory keeps existing files
+            assert_equal(catalog.prune(), [])
+            assert_equal(catalog.find(180225, 87), [filename])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def coverage_counter_test():
+
+    from goodruns import ored, anded
+    from goodruns.watch import CoverageCounter
+
+    grls = [synthetic.generate(50, seed=i, run_step=1) for i in xrange(3)]
+    counter = CoverageCounter()
+    assert_true(not counter.union())
+    assert_true(not counter.intersection())
+    for i, grl in enumerate(grls):
+        counter.add(i, grl)
+        # adding a GRL only intersects it with the cached intersection
+        if i > 0:
+            assert_equal(counter.intersected[1], set())
+        assert_equal(counter.union(), ored(*grls[:i + 1]))
+        assert_equal(counter.intersection(), anded(*grls[:i + 1]))
+    # only the union is cached
+    assert_equal(counter.combined.keys(), [1])
+    assert_equal(counter.at_least(2),
+                 ored(grls[0] & grls[1], grls[0] & grls[2],
+                      grls[1] & grls[2]))
+    run, lbrange = next(grls[0].iterlbranges())
+    assert_equal(counter.count(run, lbrange[0]),
+                 sum(1 for grl in grls if (run, lbrange[0]) in grl))
+    # replace a GRL
+    grls[1] = synthetic.generate(50, seed=10, run_step=1)
+    counter.add(1, grls[1])
+    assert_equal(counter.union(), ored(*grls))
+    assert_equal(counter.intersection(), anded(*grls))
+    # remove a GRL
+    counter.remove(0)
+    assert_equal(len(counter), 2)
+    assert_equal(counter.union(), grls[1] | grls[2])
+    assert_equal(counter.intersection(), grls[1] & grls[2])
+    assert_true(not counter.at_least(3))
+    counter.at_least(2)
+    counter.remove(1)
+    assert_equal(sorted(counter.combined), [1, 2, 3])
+    counter.discard(2)
+    counter.discard(3)
+    counter.add(1, grls[1])
+    assert_equal(counter.combined.keys(), [1])
+    assert_equal(counter.intersection(), grls[1] & grls[2])
+    counter.remove(1)
+    counter.remove(2)
+    assert_true(not counter.union())
+    assert_equal(counter.deltas, {})
+    assert_raises(ValueError, counter.at_least, 0)
+    # several changes between requests only recount the changed runs
+    for i, grl in enumerate(grls):
+        counter.add(i, grl)
+    counter.union()
+    counter.add(3, GRL({1: [(1, 10)], 2: [(1, 10)]}))
+    counter.add(4, GRL({2: [(5, 20)], 3: [(1, 10)]}))
+    assert_equal(counter.combined[1][1], set([1, 2, 3]))
+    assert_equal(counter.union(), ored(*grls) | GRL({1: [(1, 10)],
+                                                     2: [(1, 20)],
+                                                     3: [(1, 10)]}))
+
+
+def dict_normalize_test():
+
+    grl = GRL({1234: [(5, 10), (1, 2), (3, 4), (8, 12)], 1: []})
+    assert_equal(grl.to_dict(), {1234: [(1, 12)]})
+
+
+def test_arrays():
+
+    try:
+        import numpy as np
+    except ImportError:
+        raise SkipTest
+
+    grl = GRL(GRLA)
+    runs, starts, ends = grl.to_arrays()
+    assert_equal(len(runs), len(list(grl.iterlbranges())))
+    assert_equal(zip(runs.tolist(), zip(starts.tolist(), ends.tolist())),
+                 list(grl.iterlbranges()))
+    assert_equal(GRL.from_arrays(runs, starts, ends), grl)
+    # shuffled, overlapping and adjacent ranges
+    order = np.random.RandomState(1).permutation(len(runs))
+    runs, starts, ends = (
+        np.concatenate([runs[order], runs, runs]),
+        np.concatenate([starts[order], starts, ends + 1]),
+        np.concatenate([ends[order], starts, ends + 1]))
+    expected = grl | GRL(dict(
+        (run, [(lbrange[1] + 1, lbrange[1] + 1)
+               for lbrange in grl[run]]) for run in grl))
+    assert_equal(GRL.from_arrays(runs, starts, ends), expected)
+    assert_equal(GRL.from_arrays([1, 1, 2], [1, 3, 4], [2, 5, 4]).to_dict(),
+                 {1: [(1, 5)], 2: [(4, 4)]})
+    empty = GRL.from_arrays([], [], [])
+    assert_true(not empty)
+    assert_equal([len(a) for a in empty.to_arrays()], [0, 0, 0])
+    assert_raises(ValueError, GRL.from_arrays, [1], [5], [4])
+    assert_raises(ValueError, GRL.from_arrays, [1, 2], [5], [6])
+    assert_raises(TypeError, GRL.from_arrays, [1], [1.5], [4])
+    assert_raises(ValueError, GRL.from_arrays, [1], [-1], [4])
+
+
+def test_events():
+
+    try:
+        import numpy as np
+    except ImportError:
+        raise SkipTest
+
+    grl = GRL(GRLA)
+    # events in every lumiblock of the GRL
+    # in random order with duplicates
+    runs = []
+    lbs = []
+    for run in grl:
+        for lbrange in grl[run]:
+            for lbn in xrange(lbrange[0], lbrange[1] + 1):
+                runs.extend([run] * 3)
+                lbs.extend([lbn] * 3)
+    runs = np.array(runs)
+    lbs = np.array(lbs)
+    order = np.random.RandomState(1).permutation(len(runs))
+    runs = runs[order]
+    lbs = lbs[order]
+    assert_equal(GRL.from_events(runs, lbs), grl)
+    chunks = [(runs[i:i + 1000], lbs[i:i + 1000])
+              for i in xrange(0, len(runs), 1000)]
+    assert_equal(GRL.from_events(iter(chunks)), grl)
+    # sorted chunks and empty chunks
+    order = np.lexsort((lbs, runs))
+    chunks = [(runs[order][i:i + 100], lbs[order][i:i + 100])
+              for i in xrange(0, len(runs), 100)]
+    assert_equal(GRL.from_events(iter([([], [])] + chunks + [([], [])])),
+                 grl)
+    assert_equal(GRL.from_events([7, 7, 7, 7, 8], [3, 1, 2, 5, 1]).to_dict(),
+                 {7: [(1, 3), (5, 5)], 8: [(1, 1)]})
+    assert_true(not GRL.from_events([], []))
+    assert_raises(ValueError, GRL.from_events, [1, 2], [1])
+
+
 def test_read_yaml():
 
     try:
@@ -118,6 +564,616 @@ def test_read_yaml():
     os.unlink('test.yml')
 
 
+def test_read_yaml_tuples():
+
+    try:
+        import yaml
+    except ImportError:
+        raise SkipTest
+
+    # YAML written by earlier versions with python/tuple tags
+    grl = GRL("""
+1234:
+- !!python/tuple [5, 10]
+- !!python/tuple [1, 2]
+- !!python/tuple [3, 4]
+""", from_string=True, format='yml')
+    assert_equal(grl.to_dict(), {1234: [(1, 10)]})
+    assert_equal(GRL(grl.str(format='yml'), from_string=True, format='yml'),
+                 grl)
+    assert_raises(TypeError, GRL, '1: [[1.5, 7]]',
+                  from_string=True, format='yml')
+    assert_raises(TypeError, GRL, "'1': [[1, 7]]",
+                  from_string=True, format='yml')
+
+
+def json_test():
+
+    grl = GRL(GRLA)
+    grl.save('test.json')
+    grl2 = GRL('test.json')
+    assert_equal(grl, grl2)
+    os.unlink('test.json')
+    import json
+    d = json.loads(grl.str(format='json'))
+    assert_equal(sorted(int(run) for run in d), grl.runs())
+    grl = GRL('{"1234": [[5, 10], [1, 2], [2, 3]], "12": [[1, 1]]}',
+              from_string=True, format='json')
+    assert_equal(grl.runs(), [12, 1234])
+    assert_equal(grl[1234], [(1, 3), (5, 10)])
+    assert_equal(grl.str(format='json'),
+                 '{"12": [[1, 1]], "1234": [[1, 3], [5, 10]]}\n')
+    assert_raises(ValueError, GRL, '{"1": [[5, 1]]}',
+                  from_string=True, format='json')
+    assert_raises(ValueError, GRL, '[]', from_string=True, format='json')
+    assert_raises(TypeError, GRL, '{"1": [[1.5, "3"]]}',
+                  from_string=True, format='json')
+    assert_raises(TypeError, GRL, '{"1": [[1, null]]}',
+                  from_string=True, format='json')
+
+
+def convert_stdin_test():
+
+    grl = GRL(GRLA)
+    formats = ['json']
+    try:
+        import yaml
+        formats.append('yml')
+    except ImportError:
+        pass
+    for format in formats:
+        output = run_script(['convert', '--input-format', format],
+                            stdin=grl.str(format=format))
+        assert_equal(GRL(output, from_string=True), grl)
+
+
+def find_queries_test():
+
+    output = run_script(['find', '--queries', '-', GRLA, GRLB],
+                        stdin='178044 109\n1\n')
+    assert_equal(output, 'run,lb,files\n178044,109,{0};{1}\n1,,\n'.format(
+        GRLA, GRLB))
+    # --run and --lb are not used with --queries
+    for args in (['--run', '178044'], ['--lb', '109']):
+        run_script(['find', '--queries', '-'] + args + [GRLA],
+                   stdin='178044 109\n', returncode=2)
+    # an empty queries file has no matches with or without a catalog
+    import tempfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        catalog = os.path.join(tmpdir, 'catalog.db')
+        for args in ([], ['--catalog', catalog]):
+            output = run_script(['find', '--queries', '-'] + args + [GRLA],
+                                stdin='# no queries\n')
+            assert_equal(output, 'run,lb,files\n')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def metadata_test():
+
+    grl = GRL(GRLA)
+    names = [meta.name for meta in grl.metadata]
+    assert_true('RunList' in names)
+    xml = grl.str()
+    for meta in grl.metadata:
+        assert_true(meta.raw in xml)
+    grl2 = GRL(xml, from_string=True)
+    assert_equal([meta.name for meta in grl2.metadata], names)
+    assert_equal([meta.text for meta in grl2.metadata],
+                 [meta.text for meta in grl.metadata])
+    assert_equal(grl.metadata[0].get('Name'), names[0])
+    grl3 = copy.deepcopy(grl)
+    assert_equal([meta.raw for meta in grl3.metadata],
+                 [meta.raw for meta in grl.metadata])
+    assert_equal(GRL(GRLA, metadata=False).metadata, [])
+    assert_equal(GRL(GRLA, metadata=False), grl)
+
+
+def combine_lbranges_test():
+
+    from goodruns.grl import combine_lbranges, bits_to_lbranges, \
+        lbranges_to_bits
+    import random
+
+    def lbns(lbranges):
+        return set(lbn for start, end in lbranges
+                   for lbn in xrange(start, end + 1))
+
+    rng = random.Random(1)
+    first, second = [GRL({1: [(lbn, lbn) for lbn in xrange(1, 500)
+                              if rng.random() < 0.4]})[1]
+                     for i in xrange(2)]
+    assert_equal(bits_to_lbranges(lbranges_to_bits(first, 1), 1), first)
+    # fragmented runs are combined as bitmaps
+    # and the others by merging the ranges
+    for first, second in ((first, second), (first[:3], second[:3])):
+        for op, expected in (('and', lbns(first) & lbns(second)),
+                             ('or', lbns(first) | lbns(second)),
+                             ('xor', lbns(first) ^ lbns(second)),
+                             ('sub', lbns(first) - lbns(second))):
+            lbranges = combine_lbranges(first, second, op)
+            assert_equal(lbranges,
+                         GRL({1: [(lbn, lbn) for lbn in expected]})[1])
+    # a large sparse run at the limit of the bitmaps gives the same ranges
+    # as the merge (see TimeFragmented in benchmark for the timing)
+    from goodruns import grl as grl_module
+    first = [LumiblockRange(60 * i, 60 * i + 2) for i in xrange(30000)]
+    second = [LumiblockRange(60 * i + 1, 60 * i + 5) for i in xrange(30000)]
+    bitmaps = [combine_lbranges(first, second, op)
+               for op in ('and', 'or', 'xor', 'sub')]
+    min_ranges = grl_module.BITMAP_MIN_RANGES
+    grl_module.BITMAP_MIN_RANGES = len(first) + len(second) + 1
+    try:
+        assert_equal(bitmaps, [combine_lbranges(first, second, op)
+                               for op in ('and', 'or', 'xor', 'sub')])
+    finally:
+        grl_module.BITMAP_MIN_RANGES = min_ranges
+    grl = GRL({1: [(1, 10), (20, 30)]})
+    grl.insert(1, (11, 19))
+    assert_equal(grl[1], [(1, 30)])
+    grl.remove(1, (5, 25))
+    assert_equal(grl[1], [(1, 4), (26, 30)])
+    grl.remove(1, (1, 30))
+    assert_true(not grl.has_run(1))
+
+
+def union_with_sources_test():
+
+    from goodruns import ored
+    a = GRL({1: [(1, 10), (20, 30)], 2: [(5, 5)]})
+    b = GRL({1: [(5, 25)], 3: [(1, 2)]})
+    c = GRL({1: [(11, 19)]})
+    table = GRL.union_with_sources([a, b, c])
+    assert_equal(table, [(1, (1, 4), 1), (1, (5, 10), 3), (1, (11, 19), 6),
+                         (1, (20, 25), 3), (1, (26, 30), 1), (2, (5, 5), 1),
+                         (3, (1, 2), 2)])
+    table = GRL.union_with_sources([a, b, c], labels=['a', 'b', 'c'])
+    assert_equal([sources for run, lbrange, sources in table],
+                 [('a',), ('a', 'b'), ('b', 'c'), ('a', 'b'), ('a',), ('a',),
+                  ('b',)])
+    assert_raises(ValueError, GRL.union_with_sources, [a, b], labels=['a'])
+    assert_equal(GRL.union_with_sources([]), [])
+    grls = [synthetic.generate(50, seed=seed) for seed in xrange(5)]
+    table = GRL.union_with_sources(grls)
+    lbranges = {}
+    for run, lbrange, mask in table:
+        lbranges.setdefault(run, []).append(lbrange)
+        for i, grl in enumerate(grls):
+            assert_equal(bool(mask >> i & 1), (run, lbrange[0]) in grl)
+            assert_equal(bool(mask >> i & 1), (run, lbrange[1]) in grl)
+    assert_equal(GRL(lbranges), ored(*grls))
+
+
+def relations_test():
+
+    a = GRL(GRLA)
+    b = GRL(GRLB)
+    both = a & b
+    assert_true(both <= a and both.issubset(b))
+    assert_true(a >= both and b.issuperset(both))
+    assert_true(both < a and a > both)
+    assert_true(a <= a and not a < a)
+    assert_equal(a.issubset(b), not (a - b))
+    assert_equal(a.isdisjoint(b), not both)
+    assert_true((a - b).isdisjoint(b))
+    assert_equal(a.overlap_size(b), sum(lbrange[1] - lbrange[0] + 1
+                 for run, lbrange in both.iterlbranges()))
+    grl = GRL({1: [(1, 10)]})
+    assert_true(GRL({1: [(2, 5), (7, 10)]}) < grl)
+    assert_true(not GRL({1: [(2, 11)]}) <= grl)
+    assert_true(not GRL({2: [(1, 1)]}) <= grl)
+    assert_true(GRL({1: [(11, 12)], 2: [(1, 10)]}).isdisjoint(grl))
+    assert_equal(GRL({1: [(0, 2), (5, 6), (9, 20)]}).overlap_size(grl), 6)
+    # other types are left to compare themselves
+    for compare in (a.__le__, a.__ge__, a.__lt__, a.__gt__):
+        assert_true(compare(set()) is NotImplemented)
+    a <= None
+
+
+def compressed_test():
+
+    import gzip
+    import cStringIO
+    from goodruns.grl import DecompressedFile, _lzma
+    grl = GRL(GRLA)
+    compressions = ['gz', 'bz2']
+    try:
+        _lzma()
+        compressions.append('xz')
+    except ImportError:
+        assert_raises(ImportError, grl.save, 'test.xml.xz')
+    for compression in compressions:
+        for format in ('xml', 'yml', 'json'):
+            filename = 'test.{0}.{1}'.format(format, compression)
+            grl.save(filename)
+            assert_equal(GRL(filename), grl)
+            with open(filename, 'rb') as filehandle:
+                assert_equal(GRL(filehandle, format=format), grl)
+                # files passed to GRL() are left open
+                assert_true(not filehandle.closed)
+            os.unlink(filename)
+    # files opened by GRL() are closed even if they cannot be parsed
+    from goodruns import grl as grl_module
+    closed = []
+
+    class RecordingFile(DecompressedFile):
+
+        def close(self):
+            closed.append(self.fileobj)
+            DecompressedFile.close(self)
+
+    grl.save('test.xml.gz')
+    with gzip.open('test.yml.gz', 'wb') as filehandle:
+        filehandle.write('[1, 2')
+    grl_module.DecompressedFile = RecordingFile
+    try:
+        GRL('test.xml.gz')
+        assert_raises(Exception, GRL, 'test.yml.gz')
+    finally:
+        grl_module.DecompressedFile = DecompressedFile
+        os.unlink('test.xml.gz')
+        os.unlink('test.yml.gz')
+    assert_equal(len(closed), 2)
+    assert_true(all(filehandle.closed for filehandle in closed))
+    # concatenated gzip streams read in small pieces
+    data = cStringIO.StringIO()
+    for text in ('first ', 'second'):
+        stream = gzip.GzipFile(fileobj=data, mode='wb')
+        stream.write(text)
+        stream.close()
+    data.seek(0)
+    decompressed = DecompressedFile(data, 'gz', chunk_size=7)
+    assert_equal(decompressed.read(3), 'fir')
+    assert_equal(decompressed.read(), 'st second')
+    assert_equal(decompressed.read(), '')
+
+
+def fetch_test():
+
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+    from goodruns import load_many
+    from goodruns.fetch import ConnectionPool, _POOL
+    with open(GRLA) as grl_file:
+        body = grl_file.read()
+    connections = []
+    # number of GRL requests being answered and the largest number so far
+    active = [0, 0]
+    lock = threading.Lock()
+    all_active = threading.Event()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            connections.append(self.client_address)
+
+        def do_GET(self):
+            if self.path == '/old.xml':
+                self.send_response(302)
+                self.send_header('Location', '/grl.xml')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.path != '/grl.xml':
+                self.send_error(404)
+                return
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+                if active[0] == 4:
+                    all_active.set()
+            # hold the first requests until four are answered at once
+            all_active.wait(5)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            # send the body in pieces
+            for i in xrange(0, len(body), 1 << 14):
+                self.wfile.write(body[i:i + (1 << 14)])
+                self.wfile.flush()
+            with lock:
+                active[0] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{0:d}'.format(server.server_address[1])
+    try:
+        expected = GRL(GRLA)
+        grls = load_many([url + '/grl.xml'] * 4, limit=4)
+        # downloaded at the same time
+        assert_equal(active[1], 4)
+        for grl in grls:
+            assert_equal(grl, expected)
+        # connections are reused
+        count = len(connections)
+        for grl in load_many([url + '/grl.xml'] * 4, limit=4):
+            assert_equal(grl, expected)
+        assert_equal(len(connections), count)
+        assert_equal(GRL(url + '/old.xml'), expected)
+        assert_raises(IOError, GRL, url + '/missing.xml')
+        pool = ConnectionPool()
+        for i in xrange(3):
+            response = pool.urlopen(url + '/grl.xml')
+            assert_equal(response.read(), body)
+        assert_equal(pool.created, 1)
+        pool.clear()
+    finally:
+        _POOL.clear()
+        server.shutdown()
+        server.server_close()
+
+
+def batch_test():
+
+    from goodruns.batch import Pipeline
+    from goodruns import anded, xored, clipped
+    a = GRL(GRLA)
+    b = GRL(GRLB)
+    pipeline = Pipeline.from_script("""
+# comment
+A = load {0}
+B = load {1}
+AB = and A B
+X = xor A B
+C = clip AB endrun=180000
+unused = diff A B
+write AB test_batch.xml
+write C test_batch.yml
+""".format(GRLA, GRLB))
+    assert_equal(pipeline.levels(), [['AB', 'X', 'unused'], ['C']])
+    assert_equal(pipeline.needed(), set(['A', 'B', 'AB', 'C']))
+    for jobs in (1, 2):
+        grls = pipeline.run(jobs=jobs)
+        assert_true('unused' not in grls and 'X' not in grls)
+        assert_equal(GRL('test_batch.xml'), a & b)
+        assert_equal(GRL('test_batch.yml'),
+                     clipped(a & b, endrun=180000))
+        os.unlink('test_batch.xml')
+        os.unlink('test_batch.yml')
+    pipeline = Pipeline.from_string("""{
+        "sources": {"A": "%s", "B": "%s"},
+        "steps": {"X": {"op": "xor", "args": ["A", "B"]},
+                  "Y": {"op": "or", "args": ["X", "B"]}},
+        "outputs": {"Y": "test_batch.xml"}}""" % (GRLA, GRLB),
+        format='json')
+    grls = pipeline.run(jobs=2, write=False)
+    assert_equal(grls['Y'], xored(a, b) | b)
+    assert_true(not os.path.exists('test_batch.xml'))
+    assert_raises(ValueError, Pipeline.from_script, "X = nand A B")
+    assert_raises(ValueError, Pipeline.from_script, "X = and A B\nX = or A")
+    assert_raises(ValueError, Pipeline.from_script, "write X x.xml")
+    assert_raises(ValueError, Pipeline(
+        steps={'X': {'op': 'and', 'args': ['Y']},
+               'Y': {'op': 'and', 'args': ['X']}}).levels)
+    assert_raises(ValueError, Pipeline(
+        steps={'X': {'op': 'and', 'args': ['Z']}}).levels)
+
+
+def text_test():
+
+    from goodruns.grl import REPR_MAX_LINES
+    grl = GRL({1: [(1, 4), (7, 10), (12, 12)], 2: [(5, 5)]})
+    text = """---------------
+RUN: 1
+LUMIBLOCKS:
+  1  - 4
+  7  - 10
+  12
+---------------
+RUN: 2
+LUMIBLOCKS:
+  5"""
+    assert_equal(str(grl), text)
+    assert_equal(repr(grl), text)
+    assert_equal(grl.str(format='txt'), text + '\n')
+    assert_equal(list(grl.iter_text_lines()), text.split('\n'))
+    grl = synthetic.generate(100, seed=1)
+    lines = repr(grl).split('\n')
+    assert_equal(len(lines), REPR_MAX_LINES + 1)
+    assert_true(lines[-1].startswith('... (100 runs'))
+    assert_equal(len(str(grl).split('\n')),
+                 4 * len(grl.runs()) + sum(len(grl[run]) - 1 for run in grl))
+
+
+def pickle_test():
+
+    import pickle
+    grl = GRL(GRLA)
+    grl.insert(1, (1, 1 << 40))
+    for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+        grl2 = pickle.loads(pickle.dumps(grl, protocol))
+        assert_equal(grl2, grl)
+        assert_equal(grl2.name, grl.name)
+        assert_equal([meta.raw for meta in grl2.metadata],
+                     [meta.raw for meta in grl.metadata])
+        assert_true(isinstance(grl2[1][0], LumiblockRange))
+        lbrange = pickle.loads(pickle.dumps(LumiblockRange(1, 5), protocol))
+        assert_equal(lbrange, (1, 5))
+        assert_true(isinstance(lbrange, LumiblockRange))
+    assert_equal(pickle.loads(pickle.dumps(GRL(), 2)), GRL())
+    # pickles of previous releases contain the dict of the GRL
+    for old in (
+            "ccopy_reg\n_reconstructor\np0\n(cgoodruns.grl\nGRL\np1\n"
+            "c__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nS'version'\np6\n"
+            "S'1.0'\np7\nsS'name'\np8\nS'old'\np9\nsS'_GRL__grl'\np10\n"
+            "g0\n(cgoodruns.sorteddict\nSortedDict\np11\nc__builtin__\n"
+            "dict\np12\n(dp13\nI1\n(lp14\ng0\n(cgoodruns.grl\n"
+            "LumiblockRange\np15\nc__builtin__\ntuple\np16\n(I1\nI5\n"
+            "tp17\ntp18\nRp19\nag0\n(g15\ng16\n(I8\nI10\ntp20\ntp21\n"
+            "Rp22\nasI7\n(lp23\ng0\n(g15\ng16\n(I3\nI3\ntp24\ntp25\n"
+            "Rp26\nastp27\nRp28\n(dp29\nS'key_order'\np30\n(lp31\nI1\n"
+            "aI7\nasbsS'metadata'\np32\n(lp33\nsb.",
+            "\x80\x02cgoodruns.grl\nGRL\nq\x00)\x81q\x01}q\x02(U\x07"
+            "versionq\x03U\x031.0q\x04U\x04nameq\x05U\x03oldq\x06U\t"
+            "_GRL__grlq\x07cgoodruns.sorteddict\nSortedDict\nq\x08)\x81q\t"
+            "(K\x01]q\n(cgoodruns.grl\nLumiblockRange\nq\x0bK\x01K\x05"
+            "\x86q\x0c\x85q\r\x81q\x0e}q\x0fbh\x0bK\x08K\n\x86q\x10"
+            "\x85q\x11\x81q\x12}q\x13beK\x07]q\x14h\x0bK\x03K\x03\x86q"
+            "\x15\x85q\x16\x81q\x17}q\x18bau}q\x19U\tkey_orderq\x1a]q"
+            "\x1b(K\x01K\x07esbU\x08metadataq\x1c]q\x1dub."):
+        grl2 = pickle.loads(old)
+        assert_equal(grl2.name, 'old')
+        assert_equal(grl2, GRL({1: [(1, 5), (8, 10)], 7: [(3, 3)]}))
+        grl2.insert(7, (4, 6))
+        assert_equal(grl2[7], [(3, 6)])
+    grl3 = copy.deepcopy(grl)
+    grl3.insert(2, (1, 1))
+    assert_true(not grl.has_run(2))
+
+
+def shared_test():
+
+    import pickle
+    grl = GRL(GRLA)
+    with grl.to_shared() as shared:
+        assert_true(shared.owner)
+        attached = pickle.loads(pickle.dumps(shared, 2))
+        assert_true(not attached.owner)
+        assert_equal(attached.path, shared.path)
+        assert_true(pickle.loads(pickle.dumps(shared, 2)) is attached)
+        assert_equal(attached.runs(), grl.runs())
+        assert_equal(attached.to_grl(), grl)
+        run = grl.runs()[0]
+        assert_equal(attached[run], grl[run])
+        assert_raises(KeyError, attached.__getitem__, 1)
+        assert_true((run, grl[run][0][0]) in attached)
+        runlbs = [(run, lbn) for run in grl.runs() + [1]
+                  for lbn in (1, 100, 1000)]
+        assert_equal(attached.contains_many(runlbs),
+                     grl.contains_many(runlbs))
+        attached.close()
+        assert_true(attached.closed)
+    assert_true(not os.path.exists(shared.path))
+    with GRL().to_shared() as shared:
+        assert_equal(shared.runs(), [])
+        assert_equal(shared.contains_many([(1, 1)]), [False])
+
+
+def delta_test():
+
+    a, b = synthetic.generate_pair(100, overlap=0.5, seed=2)
+    b.insert(a.runs()[0], (1, 1000))
+    patch = a.delta(b)
+    assert_equal(GRL(patch.added), b - a)
+    assert_equal(GRL(patch.removed), a - b)
+    patch = GRLPatch.from_string(patch.str())
+    a.apply(patch)
+    assert_equal(a, b)
+    assert_true(not a.delta(b))
+    patch = GRLPatch.from_string("""
+name test
+version 2
+- 1 3-5
++ 1 7,10-12
++ 2 1
+""")
+    grl = GRL({1: [(1, 8)]})
+    grl.apply(patch)
+    assert_equal(grl.to_dict(), {1: [(1, 2), (6, 8), (10, 12)], 2: [(1, 1)]})
+    assert_equal(grl.version, '2')
+    assert_equal(patch.str(),
+                 'name test\nversion 2\n- 1 3-5\n+ 1 7,10-12\n+ 2 1\n')
+    # lines of the same run are merged
+    patch = GRLPatch.from_string('+ 1 1-3\n- 2 4\n+ 1 10,4-5\n- 2 1-2\n')
+    assert_equal(patch.added, {1: [(1, 5), (10, 10)]})
+    assert_equal(patch.removed, {2: [(1, 2), (4, 4)]})
+    assert_raises(ValueError, GRLPatch.from_string, '+ 1 5-3')
+    assert_raises(ValueError, GRLPatch.from_string, '* 1 1')
+
+
+def store_test():
+
+    import shutil
+    import tempfile
+    from goodruns.store import Store
+    path = tempfile.mkdtemp()
+    try:
+        store = Store(path)
+        grl = GRL(GRLA)
+        grl.version = '1'
+        digest = store.put(grl, label='A')
+        # a new version changing only one run
+        grl2 = copy.deepcopy(grl)
+        grl2.insert(grl.runs()[0], (5000, 5001))
+        grl2.version = '2'
+        digest2 = store.put(grl2, label='A2')
+        assert_true(digest != digest2)
+        assert_equal(store.put(grl), digest)
+        chunks = sum(len(files) for _, _, files in
+                     os.walk(os.path.join(path, 'chunks')))
+        assert_equal(chunks, len(grl.runs()) + 1)
+        for ref, expected in (('A', grl), (digest2, grl2)):
+            for reader in (store, Store(path)):
+                loaded = reader.get(ref)
+                assert_equal(loaded, expected)
+                # the same types as in a parsed GRL
+                for attr in ('name', 'version'):
+                    assert_equal(type(getattr(loaded, attr)),
+                                 type(getattr(expected, attr)))
+                    assert_equal(getattr(loaded, attr),
+                                 getattr(expected, attr))
+                assert_equal([(meta.name, meta.raw)
+                              for meta in loaded.metadata],
+                             [(meta.name, meta.raw)
+                              for meta in expected.metadata])
+                assert_equal(loaded.str(), expected.str())
+        assert_equal(store.labels(), [('A', digest), ('A2', digest2)])
+        assert_true('A' in store and digest2 in store)
+        assert_true('B' not in store)
+        assert_raises(KeyError, store.get, 'B')
+        assert_raises(ValueError, store.put, grl, label='../A')
+        # labels are only moved to another GRL when forced
+        assert_raises(ValueError, store.put, grl2, label='A')
+        assert_equal(store.put(grl2, label='A', force=True), digest2)
+        assert_equal(store.resolve('A'), digest2)
+        # files are created according to the umask like other files
+        umask = os.umask(0)
+        os.umask(umask)
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                mode = os.stat(os.path.join(dirpath, filename)).st_mode
+                assert_equal(mode & 0777, 0666 & ~umask)
+    finally:
+        shutil.rmtree(path)
+
+
+def store_script_test():
+
+    import shutil
+    import tempfile
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'data11_7TeV.periodA.Muon.xml.gz')
+        GRL(GRLA).save(filename)
+        GRL(GRLB).save(os.path.join(path, 'data11_7TeV.periodB.Muon.xml'))
+        store = os.path.join(path, 'store')
+        run_script(['store', 'put', '-s', store, filename,
+                    os.path.join(path, 'data11_7TeV.periodB.Muon.xml')])
+        labels = [line.split()[0] for line in
+                  run_script(['store', 'ls', '-s', store]).splitlines()]
+        assert_equal(labels, ['data11_7TeV.periodA.Muon',
+                              'data11_7TeV.periodB.Muon'])
+        run_script(['store', 'put', '-s', store, '-l',
+                    'data11_7TeV.periodA.Muon', GRLB], returncode=1)
+        run_script(['store', 'put', '-s', store, '-f', '-l',
+                    'data11_7TeV.periodA.Muon', GRLB])
+    finally:
+        shutil.rmtree(path)
+
+
 def test_ROOT():
 
     try:
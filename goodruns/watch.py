@@ -0,0 +1,254 @@
+# Author: Noel Dawe <Noel.Dawe@cern.ch>
+
+"""
+This module maintains combinations of many GRLs incrementally
+as individual GRLs are added, modified or removed
+"""
+
+from .grl import GRL
+
+import os
+from fnmatch import fnmatch
+
+
+__all__ = [
+    'CoverageCounter',
+    'Watcher',
+]
+
+
+class CoverageCounter(object):
+    """
+    Count the number of GRLs containing each lumiblock. Adding, replacing or
+    removing a GRL only updates the counts of its own lumiblock ranges and
+    the combined GRLs only recompute the runs that changed since they were
+    last requested.
+
+    The GRLs returned by union(), intersection() and at_least() are cached
+    and updated in place by later calls. Copy them before modifying them.
+    Use discard() to stop updating a combination that is no longer needed.
+    """
+    def __init__(self):
+
+        # run -> {lumiblock: change in count at this lumiblock}
+        self.deltas = {}
+        # key -> GRL
+        self.grls = {}
+        # k -> [GRL, runs changed since the GRL was last updated]
+        self.combined = {}
+        # [GRL, runs to recount] of the lumiblocks contained by all GRLs
+        self.intersected = None
+
+    def __len__(self):
+
+        return len(self.grls)
+
+    def __contains__(self, key):
+
+        return key in self.grls
+
+    def __apply(self, grl, sign):
+
+        changed = set()
+        for run, lbranges in grl.items():
+            deltas = self.deltas.setdefault(run, {})
+            for lbrange in lbranges:
+                for lbn, delta in ((lbrange[0], sign),
+                                   (lbrange[1] + 1, -sign)):
+                    value = deltas.get(lbn, 0) + delta
+                    if value:
+                        deltas[lbn] = value
+                    else:
+                        del deltas[lbn]
+            if not deltas:
+                del self.deltas[run]
+            changed.add(run)
+        for combined, runs in self.combined.values():
+            runs.update(changed)
+
+    def add(self, key, grl):
+        """
+        Add a GRL or replace the GRL previously added with the same key
+
+        *key*: hashable
+            Identifier of the GRL, e.g. its filename
+
+        *grl*: GRL
+        """
+        replaced = self.grls.get(key)
+        if replaced is not None:
+            self.__apply(replaced, -1)
+        self.grls[key] = grl
+        self.__apply(grl, 1)
+        if self.intersected is None:
+            return
+        if replaced is not None:
+            self.intersected[1].update(replaced.runs())
+            self.intersected[1].update(grl.runs())
+        elif len(self.grls) == 1:
+            self.intersected = None
+        else:
+            # lumiblocks contained by all GRLs must also be in the new one
+            self.intersected[0] &= grl
+
+    def remove(self, key):
+        """
+        Remove a GRL
+
+        *key*: hashable
+        """
+        self.__apply(self.grls.pop(key), -1)
+        if self.intersected is not None:
+            # one GRL fewer must contain each lumiblock
+            # so the lumiblocks of any run may now be in all GRLs
+            self.intersected[1].update(self.deltas)
+
+    def count(self, run, lbn):
+        """
+        Return the number of GRLs containing a run and lumiblock
+
+        *run*: int
+
+        *lbn*: int
+        """
+        deltas = self.deltas.get(run)
+        if not deltas:
+            return 0
+        return sum(delta for lb, delta in deltas.iteritems() if lb <= lbn)
+
+    def __lbranges(self, run, k):
+
+        lbranges = []
+        count = 0
+        start = None
+        deltas = self.deltas.get(run, {})
+        for lbn in sorted(deltas):
+            count += deltas[lbn]
+            if count >= k:
+                if start is None:
+                    start = lbn
+            elif start is not None:
+                lbranges.append((start, lbn - 1))
+                start = None
+        return lbranges
+
+    def at_least(self, k):
+        """
+        Return the GRL of lumiblocks contained by at least k GRLs
+
+        *k*: int
+        """
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        if k not in self.combined:
+            self.combined[k] = [GRL(), set(self.deltas)]
+        grl, runs = self.combined[k]
+        return self.__update(grl, runs, k)
+
+    def __update(self, grl, runs, k):
+
+        update = {}
+        for run in runs:
+            lbranges = self.__lbranges(run, k)
+            if lbranges:
+                update[run] = lbranges
+            elif grl.has_run(run):
+                del grl[run]
+        grl.from_dict(update)
+        runs.clear()
+        return grl
+
+    def discard(self, k):
+        """
+        Stop updating the GRL of lumiblocks contained by at least k GRLs
+
+        *k*: int
+        """
+        self.combined.pop(k, None)
+
+    def union(self):
+        """
+        Return the GRL of lumiblocks contained by any GRL
+        """
+        return self.at_least(1)
+
+    def intersection(self):
+        """
+        Return the GRL of lumiblocks contained by all GRLs
+        """
+        if not self.grls:
+            return GRL()
+        if self.intersected is None:
+            self.intersected = [GRL(), set(self.deltas)]
+        grl, runs = self.intersected
+        return self.__update(grl, runs, len(self.grls))
+
+
+class Watcher(object):
+    """
+    Keep a CoverageCounter up to date with the GRL files
+    under directories or in a list of files
+    """
+    def __init__(self, paths, pattern=None, format=None):
+        """
+        *paths*: list
+            Directories and filenames
+
+        *pattern*: [ str | None ]
+            Only include files under directories matching this pattern
+
+        *format*: [ str | None ]
+            Format passed to GRL()
+        """
+        self.paths = paths
+        self.pattern = pattern
+        self.format = format
+        self.counter = CoverageCounter()
+        # filename -> modification time
+        self.mtimes = {}
+
+    def filenames(self):
+        """
+        Return the list of GRL files currently in the watched paths
+        """
+        filenames = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, names in os.walk(path):
+                    for name in sorted(names):
+                        if self.pattern is None or fnmatch(name, self.pattern):
+                            filenames.append(os.path.join(dirpath, name))
+            elif os.path.exists(path):
+                filenames.append(path)
+        return filenames
+
+    def poll(self):
+        """
+        Update the counter with the files that were added, modified or
+        removed since the last poll. Return the list of changed files.
+        """
+        changed = []
+        seen = set()
+        for filename in self.filenames():
+            seen.add(filename)
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                continue
+            if self.mtimes.get(filename) == mtime:
+                continue
+            try:
+                grl = GRL(filename, format=self.format)
+            except Exception:
+                # the file may still be being written
+                # so try again on the next poll
+                continue
+            self.counter.add(filename, grl)
+            self.mtimes[filename] = mtime
+            changed.append(filename)
+        for filename in self.mtimes.keys():
+            if filename not in seen:
+                self.counter.remove(filename)
+                del self.mtimes[filename]
+                changed.append(filename)
+        return changed